@@ -0,0 +1,152 @@
+import ast
+import collections
+import importlib
+import sys
+import threading
+import time
+
+
+class Backend:
+    def __init__(self, name, path, modules):
+        self.name = name
+        self.path = path  # appended to sys.path before the import, like the backend's own demo expects
+        self.modules = modules
+        self.loaded = {}
+        self.state = 'pending'
+        self.error = None
+        self.seconds = None
+        self.new_modules = 0
+        self.heaviest_packages = []
+        self.callbacks = []
+        self.done = threading.Event()
+
+
+class BackendLoader:
+    """
+    Imports the model backends (whose imports load their models) one after the other in a background thread,
+    so the UI can bind its port right away. The order of the backends is the import order, which matters: SEEM
+    hits a protobuf error unless GLIGEN was imported before it. Code that needs a backend goes through a
+    LazyModule, which waits for the backend on first use.
+    """
+
+    def __init__(self, backends):
+        self.backends = collections.OrderedDict((backend.name, backend) for backend in backends)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._load_all, name="backend-loader", daemon=True)
+        self.thread.start()
+
+    def on_ready(self, name, callback):
+        # callback(modules) runs on the loader thread right after the backend is imported, before anyone waiting
+        # on it is woken up; modules maps the backend's module names to the imported modules
+        self.backends[name].callbacks.append(callback)
+
+    def wait(self, name, timeout=None):
+        backend = self.backends[name]
+        if not backend.done.wait(timeout):
+            raise TimeoutError(f"{name} is still loading")
+        if backend.state == 'failed':
+            raise RuntimeError(f"{name} failed to load: {backend.error}")
+        return backend.loaded
+
+    def module(self, name, module_name):
+        return LazyModule(self, name, module_name)
+
+    def ready(self, name=None):
+        # all backends, or only the named one
+        backends = self.backends.values() if name is None else [self.backends[name]]
+        return all(backend.state == 'ready' for backend in backends)
+
+    def done(self):
+        # every backend either loaded or failed to
+        return all(backend.done.is_set() for backend in self.backends.values())
+
+    def status(self):
+        return {
+            name: {'state': backend.state, 'seconds': backend.seconds, 'error': backend.error}
+            for name, backend in self.backends.items()
+        }
+
+    def status_markdown(self):
+        icons = {'pending': '⏳', 'loading': '⏳', 'ready': '✅', 'failed': '❌'}
+        parts = []
+        for name, backend in self.backends.items():
+            if backend.state == 'ready':
+                parts.append(f"{icons[backend.state]} {name} ({backend.seconds:.0f}s)")
+            elif backend.state == 'failed':
+                parts.append(f"{icons[backend.state]} {name} failed: {backend.error}")
+            else:
+                parts.append(f"{icons[backend.state]} {name} {backend.state}")
+        return "**Models:** " + " · ".join(parts)
+
+    def profile(self):
+        lines = [f"{'backend':<10} {'state':<8} {'import (s)':>10} {'new modules':>12}  heaviest packages"]
+        for name, backend in self.backends.items():
+            seconds = f"{backend.seconds:.1f}" if backend.seconds is not None else "-"
+            packages = ", ".join(f"{package} {count}" for package, count in backend.heaviest_packages)
+            lines.append(f"{name:<10} {backend.state:<8} {seconds:>10} {backend.new_modules:>12}  {packages}")
+        return "\n".join(lines)
+
+    def _load_all(self):
+        start = time.perf_counter()
+        for backend in self.backends.values():
+            self._load(backend)
+        print(f"Backends loaded in {time.perf_counter() - start:.1f}s\n{self.profile()}")
+
+    def _load(self, backend):
+        backend.state = 'loading'
+        before = set(sys.modules)
+        start = time.perf_counter()
+        try:
+            if backend.path is not None and backend.path not in sys.path:
+                sys.path.append(backend.path)
+            for module_name in backend.modules:
+                backend.loaded[module_name] = importlib.import_module(module_name)
+            for callback in backend.callbacks:
+                callback(backend.loaded)
+            backend.state = 'ready'
+        except Exception as ex:
+            backend.error = f"{type(ex).__name__}: {ex}"
+            backend.state = 'failed'
+        backend.seconds = time.perf_counter() - start
+
+        new_modules = set(sys.modules) - before
+        backend.new_modules = len(new_modules)
+        backend.heaviest_packages = collections.Counter(name.split('.')[0] for name in new_modules).most_common(5)
+        print(f"{backend.name} {backend.state} after {backend.seconds:.1f}s ({backend.new_modules} new modules)")
+        backend.done.set()
+
+
+class LazyModule:
+    # stands in for a backend module, attribute access waits until the backend is loaded
+    def __init__(self, loader, name, module_name):
+        self._loader = loader
+        self._name = name
+        self._module_name = module_name
+
+    def __getattr__(self, attr):
+        return getattr(self._loader.wait(self._name)[self._module_name], attr)
+
+
+def module_constants(filename, names):
+    """
+    Reads the string (or other literal) constants names from the top level of a module's source without importing
+    it, e.g. the css a backend's demo contributes to the page. Names that are missing or not literals are left out.
+    """
+    try:
+        with open(filename, 'r') as f:
+            tree = ast.parse(f.read(), filename)
+    except (OSError, SyntaxError):
+        return {}
+    constants = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name) and target.id in names:
+                try:
+                    constants[target.id] = ast.literal_eval(node.value)
+                except ValueError:
+                    constants.pop(target.id, None)
+    return constants
@@ -0,0 +1,174 @@
+import collections
+import contextlib
+import functools
+import inspect
+import threading
+import time
+
+from session_store import SESSION_KEY
+
+# lower runs first: interactive events (drags, previews) go ahead of queued model work in the same pool
+INTERACTIVE = 0
+BATCH = 1
+PRIORITIES = (INTERACTIVE, BATCH)
+
+
+class Superseded(Exception):
+    # a newer request of the same session replaced this one before it got its slot
+    pass
+
+
+class Ticket:
+    def __init__(self):
+        self.granted = False
+        self.queued_at = time.monotonic()
+
+
+class Pool:
+    """
+    At most capacity holders at a time. Waiters are served by priority, and within a priority round-robin across
+    sessions, so one session queueing many jobs only gets every n-th free slot with n sessions waiting.
+    """
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+        self.running = 0
+        # per priority: session id -> its waiting tickets, sessions in the order they are served next
+        self.waiting = {priority: collections.OrderedDict() for priority in PRIORITIES}
+        self.condition = threading.Condition()
+        self.completed = 0
+        self.superseded = 0
+        self.total_wait = 0.0
+
+    def acquire(self, session_id=None, priority=BATCH, superseded=None):
+        # superseded() is checked whenever the pool is woken, a superseded waiter leaves the queue with Superseded
+        ticket = Ticket()
+        with self.condition:
+            self.waiting[priority].setdefault(session_id, collections.deque()).append(ticket)
+            self._dispatch()
+            while not ticket.granted:
+                if superseded is not None and superseded():
+                    self._withdraw(session_id, priority, ticket)
+                    raise Superseded
+                self.condition.wait()
+            self.total_wait += time.monotonic() - ticket.queued_at
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.completed += 1
+            self._dispatch()
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def resize(self, capacity):
+        with self.condition:
+            self.capacity = capacity
+            self._dispatch()
+
+    def _withdraw(self, session_id, priority, ticket):
+        tickets = self.waiting[priority][session_id]
+        tickets.remove(ticket)
+        if not tickets:
+            del self.waiting[priority][session_id]
+        self.superseded += 1
+
+    def _dispatch(self):
+        granted = False
+        while self.running < self.capacity:
+            queue = next((self.waiting[priority] for priority in PRIORITIES if self.waiting[priority]), None)
+            if queue is None:
+                break
+            session_id, tickets = next(iter(queue.items()))
+            tickets.popleft().granted = True
+            if tickets:
+                queue.move_to_end(session_id)  # its next job waits for the other sessions' turns
+            else:
+                del queue[session_id]
+            self.running += 1
+            granted = True
+        if granted:
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'capacity': self.capacity,
+                'running': self.running,
+                'waiting': {
+                    name: sum(len(tickets) for tickets in self.waiting[priority].values())
+                    for name, priority in (('interactive', INTERACTIVE), ('batch', BATCH))
+                },
+                'completed': self.completed,
+                'superseded': self.superseded,
+                'mean_wait_seconds': self.total_wait / self.completed if self.completed else 0.0,
+            }
+
+
+def session_of(args, kwargs):
+    # the browser session a handler runs for: from its tracked state dicts, else from its gr.Request
+    values = list(args) + list(kwargs.values())
+    for value in values:
+        if isinstance(value, dict) and value.get(SESSION_KEY) is not None:
+            return value[SESSION_KEY]
+    for value in values:
+        session_hash = getattr(value, 'session_hash', None)
+        if session_hash is not None:
+            return session_hash
+    return None
+
+
+class BackendScheduler:
+    """
+    Separate concurrency pools per backend, so a cheap UI handler doesn't wait behind a multi-second generation and
+    a busy backend doesn't hold up the others. Model calls run inside slot(), whole handlers can be wrapped with
+    uses(); both wait for a free slot of their pool, served fairly across sessions.
+    """
+
+    def __init__(self, capacities):
+        self.pools = {name: Pool(name, capacity) for name, capacity in capacities.items()}
+
+    def resize(self, name, capacity):
+        self.pools[name].resize(capacity)
+
+    def wake(self, name):
+        # lets the waiters of a pool re-check whether they were superseded
+        self.pools[name].wake()
+
+    @contextlib.contextmanager
+    def slot(self, name, session_id=None, priority=BATCH, superseded=None):
+        pool = self.pools[name]
+        pool.acquire(session_id, priority, superseded)
+        try:
+            if superseded is not None and superseded():
+                raise Superseded  # superseded just as the slot became free, leave it to the newer request
+            yield
+        finally:
+            pool.release()
+
+    def uses(self, name, priority=BATCH):
+        # generator handlers, e.g. streamed chat responses, hold the slot until they are exhausted
+        def decorator(fn):
+            if inspect.isgeneratorfunction(fn):
+
+                @functools.wraps(fn)
+                def wrapper(*args, **kwargs):
+                    with self.slot(name, session_of(args, kwargs), priority):
+                        yield from fn(*args, **kwargs)
+
+            else:
+
+                @functools.wraps(fn)
+                def wrapper(*args, **kwargs):
+                    with self.slot(name, session_of(args, kwargs), priority):
+                        return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        return {name: pool.stats() for name, pool in self.pools.items()}
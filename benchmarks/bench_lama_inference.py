@@ -0,0 +1,103 @@
+"""
+Throughput of LamaEngine per inference setting (thread count, precision, channels_last, torch.compile), on CPU by
+default. Every setting is checked against the result of the first fp32 setting: fp32 settings must match it closely,
+reduced precision ones report their largest pixel difference. Pixels outside the mask must always be unchanged.
+
+Run it from the LaMa directory, like lama_server:
+
+    python /path/to/benchmarks/bench_lama_inference.py --threads 1 4 8 --precisions fp32 bf16 --channels-last both
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_config(device):
+    import yaml
+    from omegaconf import OmegaConf
+
+    with open(os.path.join(os.getcwd(), "configs/prediction/default.yaml"), "r") as f:
+        config = OmegaConf.create(yaml.safe_load(f))
+    config.model.path = os.path.join(os.getcwd(), "big-lama")
+    config.refine = False
+    config.device = device
+    return config
+
+
+def make_batch(batch_size, size, seed=0):
+    rng = np.random.default_rng(seed)
+    images = rng.integers(0, 256, size=(batch_size, size, size, 3), dtype=np.uint8)
+    masks = np.zeros((batch_size, size, size), dtype=np.uint8)
+    masks[:, size // 4 : size * 3 // 4, size // 3 : size * 2 // 3] = 255
+    return images, masks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, os.cpu_count()])
+    parser.add_argument("--precisions", type=str, nargs="+", default=["fp32", "bf16"])
+    parser.add_argument("--channels-last", type=str, default="both", choices=["off", "on", "both"])
+    parser.add_argument("--compile", type=str, default="off", choices=["off", "on", "both"])
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    from torch.utils.data._utils.collate import default_collate
+
+    from lama_predict import LamaEngine, make_sample, to_uint8
+
+    switch = {"off": [False], "on": [True], "both": [False, True]}
+    images, masks = make_batch(args.batch_size, args.size)
+    keep = masks == 0
+    reference = None
+
+    print(f"{args.batch_size}x {args.size}x{args.size} on {args.device}, median of {args.repeats} runs")
+    print(
+        f"{'threads':>7} {'precision':>9} {'channels_last':>13} {'compile':>7} {'images/s':>9} {'latency (s)':>12}"
+        f" {'max diff':>9}"
+    )
+    settings = itertools.product(args.threads, args.precisions, switch[args.channels_last], switch[args.compile])
+    for num_threads, precision, channels_last, compile_model in settings:
+        config = load_config(args.device)
+        config.num_threads = num_threads
+        config.precision = precision
+        config.channels_last = channels_last
+        config.compile = compile_model
+        engine = LamaEngine(config)
+        engine.warmup(args.size)
+
+        batch = default_collate(
+            [make_sample(image, mask, engine.pad_out_to_modulo) for image, mask in zip(images, masks)]
+        )
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            results = engine.predict_batch(batch)
+            times.append(time.perf_counter() - start)
+        latency = float(np.median(times))
+        results = np.stack([to_uint8(result) for result in results])
+
+        assert np.array_equal(results[keep], images[keep]), "pixels outside the mask changed"
+        if reference is None and precision == "fp32":
+            reference = results
+        max_diff = "-"
+        if reference is not None:
+            max_diff = int(np.abs(results.astype(int) - reference).max())
+            if precision == "fp32":
+                assert max_diff <= 2, f"fp32 setting differs from the reference by {max_diff}"
+        print(
+            f"{num_threads:>7} {precision:>9} {str(channels_last):>13} {str(compile_model):>7}"
+            f" {args.batch_size / latency:>9.2f} {latency:>12.3f} {max_diff:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
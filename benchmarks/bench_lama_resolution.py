@@ -0,0 +1,104 @@
+"""
+Latency, peak memory and quality of LamaEngine for a range of max_resolution caps on one large image. Every cap runs
+in a fresh process so the peak memory (CUDA allocator peak, or peak RSS on CPU) is its own. Quality is the PSNR of
+the hole against the native resolution result; pixels outside the mask must equal the input for every cap.
+
+Run it from the LaMa directory, like lama_server:
+
+    python /path/to/benchmarks/bench_lama_resolution.py --caps 0 2048 1024 512 --image photo.png --mask mask.png
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_input(height, width, seed=0):
+    # smooth gradients plus texture, with a hole covering an object sized region
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:height, :width].astype(np.float32)
+    image = np.stack([xx / width * 200, yy / height * 200, (xx + yy) / (width + height) * 200], axis=-1)
+    image += rng.normal(0, 20, size=image.shape)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[height // 3 : height // 3 + height // 4, width // 2 : width // 2 + width // 5] = 255
+    return image, mask
+
+
+def run(cap, roi_margin, image, mask, repeats):
+    import torch
+    import yaml
+    from omegaconf import OmegaConf
+
+    from lama_predict import LamaEngine
+
+    with open(os.path.join(os.getcwd(), "configs/prediction/default.yaml"), "r") as f:
+        config = OmegaConf.create(yaml.safe_load(f))
+    config.model.path = os.path.join(os.getcwd(), "big-lama")
+    config.refine = False
+    config.max_resolution = cap or None
+    config.roi_margin = roi_margin
+
+    engine = LamaEngine(config)
+    engine.warmup()
+    if engine.device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = engine.predict(image, mask)
+        times.append(time.perf_counter() - start)
+    if engine.device.type == "cuda":
+        peak_mb = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    return result, float(np.median(times)), peak_mb
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255.0**2 / mse)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--caps", type=int, nargs="+", default=[0, 2048, 1024, 512], help="0 is native resolution")
+    parser.add_argument("--roi-margin", type=int, default=None)
+    parser.add_argument("--image", type=str, default=None)
+    parser.add_argument("--mask", type=str, default=None)
+    parser.add_argument("--size", type=int, nargs=2, default=[3000, 4000], metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.image is not None:
+        from PIL import Image
+
+        image = np.array(Image.open(args.image).convert("RGB"))
+        mask = np.array(Image.open(args.mask).convert("L"))
+    else:
+        image, mask = make_input(*args.size)
+    hole = mask > 0
+
+    caps = [0] + [cap for cap in args.caps if cap != 0]
+    context = multiprocessing.get_context("spawn")
+    reference = None
+    print(f"{image.shape[1]}x{image.shape[0]}, hole {hole.mean() * 100:.1f}% of the image")
+    print(f"{'cap':>6} {'latency (s)':>12} {'peak memory (MB)':>17} {'PSNR hole (dB)':>15} {'outside mask':>13}")
+    for cap in caps:
+        with context.Pool(1) as pool:
+            result, latency, peak_mb = pool.apply(run, (cap, args.roi_margin, image, mask, args.repeats))
+        assert np.array_equal(result[~hole], image[~hole]), f"cap {cap} changed pixels outside the mask"
+        if reference is None:
+            reference = result
+        quality = psnr(result[hole], reference[hole])
+        print(f"{cap or 'native':>6} {latency:>12.3f} {peak_mb:>17.0f} {quality:>15.2f} {'identical':>13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Compares the payload size and latency of the /api/v2/image JSON transport with the binary /api/v3/image variants.
+Without --server only the client-side payload sizes and encode times are reported.
+
+    python benchmarks/bench_lama_transport.py --image photo.jpg --server http://localhost:9171
+"""
+import argparse
+import base64
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+import requests
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lama_codec
+
+
+def make_image(size):
+    # smooth gradients plus mild noise compress roughly like a photo, pure noise would not
+    yy, xx = np.mgrid[:size, :size].astype(np.float32) / size
+    image = np.stack([xx, yy, (xx + yy) / 2], axis=-1) * 255
+    image += np.random.default_rng(0).normal(0, 8, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def make_mask(height, width):
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[height // 3 : height // 2, width // 4 : width // 2] = 255
+    return mask
+
+
+def v2_json(image, mask):
+    # what the client used to send: base64 encoded PNGs at PIL's default compression inside a JSON body
+    data = {
+        "image": base64.b64encode(lama_codec.encode_image(image, "png", compress_level=6)).decode("utf-8"),
+        "mask": base64.b64encode(lama_codec.encode_image(mask, "png", compress_level=6)).decode("utf-8"),
+    }
+    return "/api/v2/image", dict(json=data), sum(len(value) for value in data.values())
+
+
+def v3_multipart(image_format, mask_encoding):
+    def encode(image, mask):
+        files = {
+            "image": lama_codec.encode_image(image, image_format),
+            "mask": lama_codec.encode_mask(mask, mask_encoding),
+        }
+        params = {
+            "image_format": image_format,
+            "mask_encoding": mask_encoding,
+            "width": image.shape[1],
+            "height": image.shape[0],
+        }
+        return "/api/v3/image", dict(files=files, data=params), sum(len(value) for value in files.values())
+
+    return encode
+
+
+def v3_raw_body(image, mask):
+    image_bytes = lama_codec.encode_image(image, "raw")
+    body = image_bytes + lama_codec.encode_mask(mask, "rle")
+    params = {
+        "image_format": "raw",
+        "mask_encoding": "rle",
+        "response_format": "raw",
+        "image_size": len(image_bytes),
+        "width": image.shape[1],
+        "height": image.shape[0],
+    }
+    headers = {"Content-Type": "application/octet-stream"}
+    return "/api/v3/image", dict(data=body, params=params, headers=headers), len(body)
+
+
+TRANSPORTS = {
+    "v2 json + base64 png": v2_json,
+    "v3 multipart png + bits": v3_multipart("png", "bits"),
+    "v3 multipart raw + bits": v3_multipart("raw", "bits"),
+    "v3 raw body raw + rle": v3_raw_body,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", type=str, default=None, help="defaults to a synthetic image of --size")
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--server", type=str, default=None, help="e.g. http://localhost:9171")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.image is not None:
+        image = np.array(Image.open(args.image).convert("RGB"))
+    else:
+        image = make_image(args.size)
+    mask = make_mask(*image.shape[:2])
+    print(f"image {image.shape[1]}x{image.shape[0]}")
+
+    session = requests.Session()
+    print(f"{'transport':<26} {'payload (KiB)':>14} {'encode (ms)':>12} {'round trip p50 (ms)':>20}")
+    for name, encode in TRANSPORTS.items():
+        start = time.perf_counter()
+        path, kwargs, payload_size = encode(image, mask)
+        encode_ms = (time.perf_counter() - start) * 1000
+
+        latency = "-"
+        if args.server is not None:
+            timings = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                _, kwargs, _ = encode(image, mask)
+                response = session.post(args.server + path, **kwargs)
+                response.raise_for_status()
+                timings.append((time.perf_counter() - start) * 1000)
+            latency = f"{statistics.median(timings):.1f}"
+        print(f"{name:<26} {payload_size / 1024:>14.1f} {encode_ms:>12.1f} {latency:>20}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Compares moving an object the way changed_objects_handler does with the per-pixel loop it replaced. A first move
+lifts the object off the frame into an ObjectLayer through the SegmentIndex built once per segmentation, then
+shifts the layer's offset; later moves only shift the offset. The speedup is loop vs first move.
+
+    python benchmarks/bench_object_move.py --sizes 512 1024 2048
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compose_layers import ObjectLayer, SegmentIndex
+
+
+def move_object_loop(img, obj_id, pos_x, pos_y):
+    # the original changed_objects_handler implementation, kept here as the reference
+    new_img = np.zeros_like(img)
+    for i in range(img.shape[0]):
+        for j in range(img.shape[1]):
+            if img[i, j, 3] == obj_id:
+                new_i = i + pos_y
+                new_j = j + pos_x
+                if new_i >= 0 and new_i < img.shape[0] and new_j >= 0 and new_j < img.shape[1]:
+                    new_img[new_i, new_j] = img[i, j]
+                img[i, j] = 0
+    return new_img
+
+
+def make_layer(size, obj_id=1, seed=0):
+    # a random RGBA frame with one elliptical object covering roughly 10% of it
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, size=(size, size, 4), dtype=np.uint8)
+    img[:, :, 3] = 0
+    yy, xx = np.ogrid[:size, :size]
+    cy, cx, r = size * 0.6, size * 0.4, size * 0.18
+    img[(yy - cy) ** 2 + ((xx - cx) * 0.8) ** 2 < r**2, 3] = obj_id
+    return img
+
+
+def timed(fn, img, *args):
+    start = time.perf_counter()
+    out = fn(img, *args)
+    return out, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--skip-loop", action="store_true", help="only time the ObjectLayer moves")
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'move':>11} {'loop (s)':>10} {'first move (s)':>15} {'later move (s)':>15} {'speedup':>9}")
+    for size in args.sizes:
+        for name, (pos_x, pos_y) in {"drag": (size // 7, -size // 5), "remove": (10000, 10000)}.items():
+            layer = make_layer(size)
+            index, index_time = timed(SegmentIndex, layer[:, :, 3], [1])
+
+            start = time.perf_counter()
+            obj_layer = index.layer(layer, 1)
+            obj_layer.move(pos_x, pos_y)
+            first_time = time.perf_counter() - start
+            moved = obj_layer.to_frame()
+            _, later_time = timed(ObjectLayer.move, obj_layer, 1, 1)
+            if args.skip_loop:
+                print(f"{size:>6} {name:>11} {'-':>10} {first_time:>15.6f} {later_time:>15.6f} {'-':>9}")
+                continue
+            loop_out, loop_time = timed(move_object_loop, layer.copy(), 1, pos_x, pos_y)
+            assert np.array_equal(loop_out, moved), "results differ"
+            print(
+                f"{size:>6} {name:>11} {loop_time:>10.3f} {first_time:>15.6f} {later_time:>15.6f}"
+                f" {loop_time / first_time:>8.0f}x"
+            )
+        print(f"{size:>6} {'index build':>11} {'-':>10} {index_time:>15.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Fires N simultaneous, distinct inpaint requests at a running lama_server and checks that every response belongs
+to its own request: the size must match and every pixel outside the mask must equal the request's input.
+
+    python benchmarks/check_lama_concurrency.py --url http://localhost:9171/api/v2/image -n 16
+"""
+import argparse
+import base64
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from PIL import Image
+
+
+def make_request(seed):
+    # every request gets its own size, content and hole so a mix-up can't go unnoticed
+    rng = np.random.default_rng(seed)
+    height, width = rng.integers(200, 520, size=2)
+    image = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    top, left = rng.integers(0, height // 2), rng.integers(0, width // 2)
+    mask[top : top + height // 4, left : left + width // 4] = 255
+    return image, mask
+
+
+def encode_png(array):
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def post(url, image, mask):
+    data = {"image": encode_png(image), "mask": encode_png(mask)}
+    start = time.perf_counter()
+    response = requests.post(url, json=data, timeout=600)
+    response.raise_for_status()
+    return np.array(Image.open(io.BytesIO(response.content)).convert("RGB")), time.perf_counter() - start
+
+
+def check(image, mask, result):
+    if result.shape != image.shape:
+        return f"shape {result.shape} != {image.shape}"
+    keep = mask == 0
+    if not np.array_equal(result[keep], image[keep]):
+        return "pixels outside the mask differ from the input"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://localhost:9171/api/v2/image")
+    parser.add_argument("-n", "--num-requests", type=int, default=16)
+    args = parser.parse_args()
+
+    inputs = [make_request(seed) for seed in range(args.num_requests)]
+    with ThreadPoolExecutor(max_workers=args.num_requests) as pool:
+        futures = [pool.submit(post, args.url, image, mask) for image, mask in inputs]
+        outputs = [future.result() for future in futures]
+
+    failures = 0
+    for i, ((image, mask), (result, latency)) in enumerate(zip(inputs, outputs)):
+        error = check(image, mask, result)
+        failures += error is not None
+        print(f"request {i:>3} {image.shape[1]}x{image.shape[0]} {latency:7.3f}s {error or 'ok'}")
+
+    print(f"{args.num_requests - failures}/{args.num_requests} responses matched their own input")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Load test for lama_server: C clients send N distinct inpaint requests (so the result cache never hits) through
+LamaClient and the throughput and latency percentiles are reported. Either against a running server, or for
+several server configurations in turn, each launched from the LaMa directory and stopped with SIGTERM:
+
+    python benchmarks/load_test_lama.py --url http://localhost:9171 -n 200 -c 8
+    python benchmarks/load_test_lama.py --lama-dir lama -n 200 -c 8 \
+        --configs "--server waitress --threads 8" "--server gunicorn --workers 2 --threads 4"
+"""
+import argparse
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO)
+from lama_client import LamaClient
+from wait_for_ready import lama_probe, wait_for_ready
+
+
+def make_requests(count, size, seed=0):
+    rng = np.random.default_rng(seed)
+    requests = []
+    for _ in range(count):
+        image = rng.integers(0, 256, size=(size, size, 3), dtype=np.uint8)
+        mask = np.zeros((size, size), dtype=np.uint8)
+        top, left = rng.integers(0, size // 2, size=2)
+        mask[top : top + size // 4, left : left + size // 4] = 255
+        requests.append((image, mask))
+    return requests
+
+
+def run_load(url, requests, concurrency, timeout):
+    client = LamaClient(url, timeout=timeout, retries=0, pool_size=concurrency)
+
+    def send(request):
+        start = time.perf_counter()
+        try:
+            client.inpaint(*request)
+        except Exception as ex:
+            return None, f"{type(ex).__name__}: {ex}"
+        return time.perf_counter() - start, None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(send, requests))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results if latency is not None])
+    errors = [error for _, error in results if error is not None]
+    return elapsed, latencies, errors
+
+
+def report(name, elapsed, latencies, errors):
+    if len(latencies) == 0:
+        print(f"{name:<50} all {len(errors)} requests failed, e.g. {errors[0]}")
+        return
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"{name:<50} {len(latencies) / elapsed:>8.2f} {p50:>8.3f} {p95:>8.3f} {p99:>8.3f} {len(errors):>7}")
+
+
+def workers_of(config):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--workers", type=int, default=1)
+    return parser.parse_known_args(shlex.split(config))[0].workers
+
+
+def launch(config, lama_dir, port):
+    command = [sys.executable, os.path.join(REPO, "lama_server.py"), "--port", str(port)] + shlex.split(config)
+    return subprocess.Popen(command, cwd=lama_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://localhost:9171")
+    parser.add_argument("--configs", type=str, nargs="*", default=None, help="lama_server arguments to launch with")
+    parser.add_argument("--lama-dir", type=str, default=".", help="where launched servers run, like run_demo.sh")
+    parser.add_argument("--port", type=int, default=9271, help="port of launched servers")
+    parser.add_argument("-n", "--requests", type=int, default=100)
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    requests = make_requests(args.requests, args.size)
+    print(f"{args.requests} requests of {args.size}x{args.size}, {args.concurrency} concurrent clients")
+    print(f"{'server':<50} {'req/s':>8} {'p50 (s)':>8} {'p95 (s)':>8} {'p99 (s)':>8} {'errors':>7}")
+    if not args.configs:
+        report(args.url, *run_load(args.url, requests, args.concurrency, args.timeout))
+        return
+
+    url = f"http://127.0.0.1:{args.port}"
+    for config in args.configs:
+        server = launch(config, args.lama_dir, args.port)
+        try:
+            probe = lama_probe(url, workers_of(config))
+            if not wait_for_ready([probe], timeout=args.timeout, interval=0.1, log=lambda message: None):
+                print(f"{config:<50} did not become ready")
+                continue
+            report(config, *run_load(url, requests, args.concurrency, args.timeout))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import cv2
+import numpy as np
+from scipy import ndimage
+
+
+class SegmentIndex:
+    """
+    Bounding box and pixel mask of every segmented object, built once from the alpha channel SEEM returns
+    (alpha == obj_id marks the object's pixels). The mask only covers the object's box, one byte per pixel of it.
+    Later moves, masks and bbox queries read from here instead of rescanning the frame.
+    """
+
+    def __init__(self, alpha, obj_ids):
+        self.shape = alpha.shape
+        # obj_id -> (rows, cols, mask of the alpha[rows, cols] box)
+        self.objects = {}
+
+        # one pass over the frame finds every label's bounding slices; label 0 is treated as background
+        slices = ndimage.find_objects(alpha)
+        for obj_id in obj_ids:
+            if obj_id == 0:
+                box = next(iter(ndimage.find_objects((alpha == 0).view(np.uint8))), None)
+            else:
+                box = slices[obj_id - 1] if obj_id <= len(slices) else None
+            if box is None:
+                self.objects[obj_id] = (slice(0, 0), slice(0, 0), np.zeros((0, 0), dtype=bool))
+            else:
+                rows, cols = box
+                self.objects[obj_id] = (rows, cols, alpha[rows, cols] == obj_id)
+
+    @property
+    def nbytes(self):
+        return sum(mask.nbytes for _, _, mask in self.objects.values())
+
+    def coords(self, obj_id):
+        rows, cols, mask = self.objects[obj_id]
+        ys, xs = np.nonzero(mask)
+        return ys + rows.start, xs + cols.start
+
+    def bbox(self, obj_id):
+        rows, cols, mask = self.objects[obj_id]
+        if mask.size == 0:
+            return None
+        return (cols.start, rows.start, cols.stop - 1, rows.stop - 1)
+
+    def count(self, obj_id):
+        return int(np.count_nonzero(self.objects[obj_id][2]))
+
+    def layer(self, img, obj_id):
+        # copies the object out of the full frame img
+        rows, cols, mask = self.objects[obj_id]
+        return ObjectLayer.from_mask(img[rows, cols], mask, rows.start, cols.start, img.shape)
+
+    def mask(self, obj_ids):
+        # union of the masks of obj_ids, 255 inside
+        return self.update_mask(np.zeros(self.shape, dtype=np.uint8), (), obj_ids)
+
+    def update_mask(self, mask, old_ids, new_ids):
+        """
+        Updates, in place, a union mask of old_ids so it covers new_ids instead. Only the pixels of objects that
+        were added or removed are touched.
+        """
+        old_ids, new_ids = set(old_ids), set(new_ids)
+        for obj_id in old_ids - new_ids:
+            if obj_id in self.objects:
+                rows, cols, obj_mask = self.objects[obj_id]
+                mask[rows, cols][obj_mask] = 0
+        for obj_id in new_ids - old_ids:
+            if obj_id in self.objects:
+                rows, cols, obj_mask = self.objects[obj_id]
+                mask[rows, cols][obj_mask] = 255
+        return mask
+
+
+def label_mask(alpha, obj_ids):
+    # union mask (255 inside) of every pixel whose label is in obj_ids, through a lookup table over the labels
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[list(obj_ids)] = 255
+    return lut[alpha]
+
+
+def mask_distance(mask):
+    """
+    Euclidean distance of every pixel to the nearest non-zero pixel of mask. Computed once per mask, it turns
+    dilation into a threshold: distance <= k / 2 matches dilating with a k x k elliptical kernel up to the
+    kernel's anchor offset, for any k.
+    """
+    return cv2.distanceTransform((mask == 0).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+
+
+def dilate_by_distance(distance, kernel_size):
+    return (distance <= kernel_size / 2).astype(np.uint8) * np.uint8(255)
+
+
+class ObjectLayer:
+    """
+    A moved object, stored as the RGBA pixels of its bounding box plus the box's offset in the frame, so its memory
+    scales with the object instead of the frame. Moving only shifts the offset (and crops whatever leaves the
+    frame); the full frame layer is only composed on request.
+    """
+
+    __slots__ = ('pixels', 'mask', 'top', 'left', 'frame_shape')
+
+    def __init__(self, pixels, mask, top, left, frame_shape):
+        self.pixels = pixels
+        self.mask = mask
+        self.top = top
+        self.left = left
+        self.frame_shape = frame_shape
+
+    @classmethod
+    def from_coords(cls, img, coords):
+        # copies the object at coords (ys, xs) out of the full frame img
+        ys, xs = coords
+        if ys.size == 0:
+            return cls(np.zeros((0, 0) + img.shape[2:], img.dtype), np.zeros((0, 0), bool), 0, 0, img.shape)
+        top, left = int(ys.min()), int(xs.min())
+        height, width = int(ys.max()) - top + 1, int(xs.max()) - left + 1
+        pixels = np.zeros((height, width) + img.shape[2:], dtype=img.dtype)
+        mask = np.zeros((height, width), dtype=bool)
+        pixels[ys - top, xs - left] = img[ys, xs]
+        mask[ys - top, xs - left] = True
+        return cls(pixels, mask, top, left, img.shape)
+
+    @classmethod
+    def from_mask(cls, box, mask, top, left, frame_shape):
+        # copies the object marked by mask out of box, the part of the frame at (top, left) that mask covers
+        pixels = np.zeros_like(box)
+        pixels[mask] = box[mask]
+        return cls(pixels, mask.copy(), top, left, frame_shape)
+
+    def move(self, pos_x, pos_y):
+        # pixels moved out of the frame are dropped, like they are when moving on a full frame layer
+        top, left = self.top + pos_y, self.left + pos_x
+        height, width = self.mask.shape
+        y0, y1 = max(0, -top), min(height, self.frame_shape[0] - top)
+        x0, x1 = max(0, -left), min(width, self.frame_shape[1] - left)
+        y1, x1 = max(y0, y1), max(x0, x1)
+        if (y0, y1, x0, x1) != (0, height, 0, width):
+            # copies, slices would keep the whole previous box alive and nbytes would undercount it
+            self.pixels = self.pixels[y0:y1, x0:x1].copy()
+            self.mask = self.mask[y0:y1, x0:x1].copy()
+        self.top, self.left = top + y0, left + x0
+
+    @property
+    def nbytes(self):
+        return self.pixels.nbytes + self.mask.nbytes
+
+    def coords(self):
+        ys, xs = np.nonzero(self.mask)
+        return ys + self.top, xs + self.left
+
+    def bbox(self):
+        # tight (min_x, min_y, max_x, max_y) of the object pixels in the frame, None once it left the frame
+        rows = np.flatnonzero(self.mask.any(axis=1))
+        if rows.size == 0:
+            return None
+        cols = np.flatnonzero(self.mask.any(axis=0))
+        return (self.left + int(cols[0]), self.top + int(rows[0]), self.left + int(cols[-1]), self.top + int(rows[-1]))
+
+    def paste_into(self, frame):
+        height, width = self.mask.shape
+        region = frame[self.top : self.top + height, self.left : self.left + width]
+        region[self.mask] = self.pixels[self.mask]
+        return frame
+
+    def to_frame(self):
+        return self.paste_into(np.zeros(self.frame_shape, dtype=self.pixels.dtype))
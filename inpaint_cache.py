@@ -0,0 +1,135 @@
+import collections
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+
+class InpaintCache:
+    """
+    Content addressed LRU cache of inpainted images, keyed on a hash of the (image, mask) pair and the namespace,
+    e.g. the engine's fingerprint, so results computed with another checkpoint or other settings are not served.
+
+    Results live in memory up to max_bytes. With disk_dir set they are also written there as .npy files, bounded
+    by max_disk_bytes, so they survive memory eviction and server restarts. Least recently used entries are
+    evicted first on both layers.
+    """
+
+    def __init__(self, max_bytes=512 * 2**20, disk_dir=None, max_disk_bytes=2 * 2**30, namespace=''):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_dir = disk_dir
+        self.namespace = namespace
+        self.lock = threading.Lock()
+
+        self.entries = collections.OrderedDict()  # key -> array
+        self.nbytes = 0
+        self.disk_entries = collections.OrderedDict()  # key -> file size
+        self.disk_nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            files = [entry for entry in os.scandir(disk_dir) if entry.name.endswith(".npy")]
+            for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+                self.disk_entries[entry.name[: -len(".npy")]] = entry.stat().st_size
+                self.disk_nbytes += entry.stat().st_size
+            self._evict_disk()
+
+    def key(self, image, mask):
+        # lama only looks at mask > 0, so masks that differ in the hole's gray levels share an entry
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(self.namespace.encode())
+        digest.update(repr((image.shape, str(image.dtype))).encode())
+        digest.update(np.ascontiguousarray(image).data)
+        digest.update(np.packbits(np.asarray(mask) > 0).data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if key not in self.disk_entries:
+                self.misses += 1
+                return None
+            self.disk_entries.move_to_end(key)
+
+        try:
+            value = np.load(self._path(key))
+        except (OSError, ValueError):
+            with self.lock:
+                self._drop_disk_entry(key)
+                self.misses += 1
+            return None
+        value.flags.writeable = False
+        with self.lock:
+            self.disk_hits += 1
+            self._put_memory(key, value)
+        return value
+
+    def put(self, key, value):
+        value = np.array(value)
+        value.flags.writeable = False
+        with self.lock:
+            self._put_memory(key, value)
+            write_to_disk = self.disk_dir is not None and key not in self.disk_entries
+            if write_to_disk:
+                # reserve the entry so concurrent puts of the same key write the file only once
+                self.disk_entries[key] = value.nbytes
+                self.disk_nbytes += value.nbytes
+        if write_to_disk:
+            tmp_path = self._path(key) + f".{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, value)
+            os.replace(tmp_path, self._path(key))
+            file_size = os.path.getsize(self._path(key))
+            with self.lock:
+                if key in self.disk_entries:
+                    self.disk_nbytes += file_size - self.disk_entries[key]
+                    self.disk_entries[key] = file_size
+                self._evict_disk()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'disk_entries': len(self.disk_entries),
+                'disk_bytes': self.disk_nbytes,
+                'max_disk_bytes': self.max_disk_bytes if self.disk_dir is not None else 0,
+            }
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + ".npy")
+
+    def _put_memory(self, key, value):
+        if value.nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def _drop_disk_entry(self, key):
+        self.disk_nbytes -= self.disk_entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict_disk(self):
+        while self.disk_nbytes > self.max_disk_bytes and self.disk_entries:
+            self._drop_disk_entry(next(iter(self.disk_entries)))
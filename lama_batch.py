@@ -0,0 +1,141 @@
+"""
+Bulk offline inpainting, e.g. pre-inpainting the demo's sample gallery. Reads the same input layout as
+lama_predict.main (images with their *mask*.png files, see make_default_val_dataset) and overlaps the three
+stages: DataLoader workers decode the next images while the model runs batched forward passes and a writer pool
+encodes and saves finished ones. Outputs that already exist are skipped, so an interrupted job resumes where it
+stopped.
+
+Run it from the LaMa directory, like lama_server:
+
+    python ../lama_batch.py --indir samples --outdir samples_inpainted --batch-size 4 --workers 4
+"""
+import argparse
+import collections
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import torch
+import tqdm
+import yaml
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader, Dataset
+
+from lama_predict import LamaEngine, collate_padded, make_sample, sample_to_arrays, to_uint8
+from saicinpainting.training.data.datasets import make_default_val_dataset
+
+
+class ArrayDataset(Dataset):
+    # the pending items of a LaMa dataset as (index, RGB uint8 image, uint8 mask), decoded in the loader workers
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        index = self.indices[i]
+        return (index, *sample_to_arrays(self.dataset[index]))
+
+
+def as_list(items):
+    return items
+
+
+def init_worker(worker_id):
+    # the loader workers only decode, one thread each keeps them from competing with the model for cores
+    torch.set_num_threads(1)
+    cv2.setNumThreads(1)
+
+
+def output_path(indir, outdir, mask_fname, out_ext):
+    return os.path.join(outdir, os.path.splitext(mask_fname[len(indir) :])[0] + out_ext)
+
+
+def write_image(path, image):
+    # written under a temporary name first, a job killed mid-write must not leave an output that looks done
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.tmp{ext}"
+    cv2.imwrite(tmp_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    os.replace(tmp_path, path)
+
+
+def run_batch(engine, items):
+    # items: (index, image, mask); returns (index, inpainted uint8 image) pairs
+    prepared = [engine.prepare(image, mask) for _, image, mask in items]
+    samples = [make_sample(image, mask, engine.pad_out_to_modulo) for image, mask, _ in prepared]
+    results = engine.predict_batch(collate_padded(samples))
+    finished = []
+    for (index, _, _), (_, _, finish), cur_res in zip(items, prepared, results):
+        finished.append((index, finish(to_uint8(cur_res))))
+    return finished
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--indir", type=str, required=True)
+    parser.add_argument("--outdir", type=str, required=True)
+    parser.add_argument("--config", type=str, default="configs/prediction/default.yaml")
+    parser.add_argument("--model-path", type=str, default="big-lama")
+    parser.add_argument("--device", type=str, default=None, help="overrides the config's device")
+    parser.add_argument("--out-ext", type=str, default=".png")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4, help="DataLoader processes decoding inputs")
+    parser.add_argument("--writers", type=int, default=2, help="threads encoding and writing outputs")
+    parser.add_argument("--overwrite", action="store_true", help="redo outputs that already exist")
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"])
+    parser.add_argument("--roi-margin", type=int, default=None)
+    parser.add_argument("--max-resolution", type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = OmegaConf.create(yaml.safe_load(f))
+    config.model.path = os.path.abspath(args.model_path)
+    config.refine = False
+    if args.device is not None:
+        config.device = args.device
+    config.num_threads = args.num_threads
+    config.precision = args.precision
+    config.roi_margin = args.roi_margin
+    config.max_resolution = args.max_resolution
+
+    indir = args.indir if args.indir.endswith('/') else args.indir + '/'
+    dataset = make_default_val_dataset(indir, **config.dataset)
+    outputs = [output_path(indir, args.outdir, fname, args.out_ext) for fname in dataset.mask_filenames]
+    pending = [i for i, path in enumerate(outputs) if args.overwrite or not os.path.exists(path)]
+    print(f"{len(dataset)} images, {len(dataset) - len(pending)} already done, {len(pending)} to inpaint")
+    if len(pending) == 0:
+        return
+
+    engine = LamaEngine(config)
+    loader = DataLoader(
+        ArrayDataset(dataset, pending),
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+        collate_fn=as_list,
+        worker_init_fn=init_worker,
+    )
+
+    start = time.perf_counter()
+    writes = collections.deque()
+    with ThreadPoolExecutor(args.writers, thread_name_prefix="lama-writer") as writer:
+        with tqdm.tqdm(total=len(pending), unit="img") as progress:
+            for items in loader:
+                for index, image in run_batch(engine, items):
+                    writes.append(writer.submit(write_image, outputs[index], image))
+                # bound the finished images waiting in memory for the writers
+                while len(writes) > 4 * args.batch_size or (writes and writes[0].done()):
+                    writes.popleft().result()
+                progress.update(len(items))
+        for write in writes:
+            write.result()
+    elapsed = time.perf_counter() - start
+    print(f"Inpainted {len(pending)} images in {elapsed:.1f}s, {len(pending) / elapsed:.2f} images/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from lama_predict import collate_padded, make_sample, to_uint8
+
+
+class BatchScheduler:
+    """
+    Queues inpaint requests in front of a LamaEngine and runs them as batches: a batch is closed when it has
+    max_batch_size requests or max_wait_ms after its first request arrived, whichever comes first.
+    Samples of different sizes are padded to the largest one and cropped back afterwards. Requests are queued as
+    LamaEngine.prepare makes them, i.e. only the window around the hole or downscaled, and restored to full size
+    when their batch is done.
+    """
+
+    def __init__(self, engine, max_batch_size=4, max_wait_ms=10.0):
+        self.engine = engine
+        # the refiner optimizes one image at a time
+        self.max_batch_size = 1 if engine.refine else max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.batch_sizes = collections.Counter()
+        self.queue_depths = collections.Counter()
+        self.worker = threading.Thread(target=self._run, name="lama-batch-scheduler", daemon=True)
+        self.worker.start()
+
+    def submit(self, image, mask):
+        # the sample is built on the caller's thread so preprocessing of queued requests overlaps inference
+        if image.ndim != 3 or image.shape[2] != 3 or mask.shape != image.shape[:2]:
+            raise ValueError(f"Expected an HxWx3 image and an HxW mask, got {image.shape} and {mask.shape}")
+        future = Future()
+        image, mask, finish = self.engine.prepare(image, mask)
+        self.queue.put((make_sample(image, mask, self.engine.pad_out_to_modulo), future, finish))
+        return future
+
+    def predict(self, image, mask, timeout=None):
+        return self.submit(image, mask).result(timeout)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000.0,
+            'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+            'queue_depth_histogram': dict(sorted(self.queue_depths.items())),
+        }
+
+    def _next_batch(self):
+        requests = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(requests) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                requests.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        # drop requests whose caller gave up while they were queued
+        return [request for request in requests if request[1].set_running_or_notify_cancel()]
+
+    def _run(self):
+        while True:
+            self.queue_depths[self.queue.qsize()] += 1
+            requests = self._next_batch()
+            if len(requests) == 0:
+                continue
+            self.batch_sizes[len(requests)] += 1
+            self._complete(requests)
+
+    def _complete(self, requests):
+        try:
+            results = self.engine.predict_batch(collate_padded([sample for sample, _, _ in requests]))
+        except Exception as ex:
+            if len(requests) == 1:
+                requests[0][1].set_exception(ex)
+                return
+            # one bad request must not fail the rest of its batch, so they are retried one at a time
+            for request in requests:
+                self._complete([request])
+            return
+        for (_, future, finish), cur_res in zip(requests, results):
+            try:
+                future.set_result(finish(to_uint8(cur_res)))
+            except Exception as ex:
+                future.set_exception(ex)
@@ -0,0 +1,60 @@
+from urllib.parse import urlparse
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import lama_codec
+
+
+class LamaClient:
+    """
+    Shared client for lama_server. Connections are pooled and kept alive across calls, every call has a timeout
+    and calls that didn't reach the model (connection errors, 502/503) are retried with exponential backoff.
+    """
+
+    def __init__(self, base_url="http://localhost:9171", timeout=120.0, retries=2, backoff_factor=0.5, pool_size=8):
+        self.base_url = base_url.rstrip("/")
+        # (connect, read) timeout; connecting to a healthy server should never take long
+        self.timeout = (min(5.0, timeout), timeout)
+        # uncompressed pixels are cheapest on localhost, PNG pays off once the server is across a network
+        is_local = urlparse(self.base_url).hostname in ("localhost", "127.0.0.1", "::1")
+        self.image_format = "raw" if is_local else "png"
+
+        # a read timeout or the server's 504 means a forward pass already hit its time limit, retrying would only
+        # queue another one on a server that is overloaded; 503 is what it answers while the model loads
+        retry = Retry(
+            total=retries,
+            read=0,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503),
+            allowed_methods=frozenset(["GET", "POST"]),  # inpainting is idempotent
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def inpaint(self, image, mask):
+        """
+        Inpaints the non-zero region of mask (HxW) in the RGB image (HxWx3) and returns the result as a uint8
+        HxWx3 array. Raises requests.RequestException when the server can't be reached or answers with an error.
+        """
+        image = np.asarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        files = {
+            "image": lama_codec.encode_image(image, self.image_format),
+            "mask": lama_codec.encode_mask(mask, "bits"),
+        }
+        data = {
+            "image_format": self.image_format,
+            "mask_encoding": "bits",
+            "response_format": self.image_format,
+            "width": width,
+            "height": height,
+        }
+        response = self.session.post(self.base_url + "/api/v3/image", files=files, data=data, timeout=self.timeout)
+        response.raise_for_status()
+        return lama_codec.decode_image(response.content, self.image_format, width, height)
@@ -0,0 +1,78 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+# wire formats of the /api/v3/image endpoint, shared by lama_server and its clients
+IMAGE_FORMATS = ('png', 'raw')
+MASK_ENCODINGS = ('png', 'bits', 'rle')
+
+
+def encode_image(image, image_format='png', compress_level=1):
+    """
+    Encodes an RGB uint8 image (HxWx3 array or PIL image). 'raw' is the bare pixel buffer, which is the
+    cheapest choice for localhost traffic; 'png' is lossless and smaller on the wire.
+    """
+    if image_format == 'raw':
+        return np.ascontiguousarray(np.asarray(image, dtype=np.uint8)).tobytes()
+    if image_format == 'png':
+        if not isinstance(image, Image.Image):
+            image = Image.fromarray(image)
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', compress_level=compress_level)
+        return buffer.getvalue()
+    raise ValueError(f"Unknown image format: {image_format}")
+
+
+def decode_image(data, image_format='png', width=None, height=None, mode='RGB'):
+    if image_format == 'raw':
+        channels = len(mode)
+        image = np.frombuffer(data, dtype=np.uint8)
+        if image.size != width * height * channels:
+            raise ValueError(f"Expected {width}x{height}x{channels} bytes of raw pixels, got {image.size}")
+        return image.reshape((height, width, channels) if channels > 1 else (height, width))
+    if image_format == 'png':
+        image = Image.open(io.BytesIO(data))
+        if image.mode != mode:
+            image = image.convert(mode)
+        return np.array(image)
+    raise ValueError(f"Unknown image format: {image_format}")
+
+
+def encode_mask(mask, encoding='bits'):
+    """
+    Encodes a binary mask (non-zero marks the hole). 'bits' packs 8 pixels per byte; 'rle' stores alternating
+    run lengths (as uint32, starting with a run of zeros), which is smallest for a few compact holes.
+    """
+    mask = np.asarray(mask)
+    if encoding == 'png':
+        return encode_image(mask.astype(np.uint8), 'png')
+    if encoding == 'bits':
+        return np.packbits(mask.ravel() > 0).tobytes()
+    if encoding == 'rle':
+        flat = mask.ravel() > 0
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        boundaries = np.concatenate(([0], changes, [flat.size]))
+        runs = np.diff(boundaries)
+        if flat.size > 0 and flat[0]:
+            runs = np.concatenate(([0], runs))
+        return runs.astype('<u4').tobytes()
+    raise ValueError(f"Unknown mask encoding: {encoding}")
+
+
+def decode_mask(data, encoding='bits', width=None, height=None):
+    # returns a uint8 mask with 255 in the hole
+    if encoding == 'png':
+        return decode_image(data, 'png', mode='L')
+    if encoding == 'bits':
+        if len(data) != (width * height + 7) // 8:
+            raise ValueError(f"Expected {(width * height + 7) // 8} bytes of packed mask bits, got {len(data)}")
+        flat = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=width * height)
+    elif encoding == 'rle':
+        runs = np.frombuffer(data, dtype='<u4')
+        if int(runs.sum()) != width * height:
+            raise ValueError(f"Run lengths cover {int(runs.sum())} pixels, expected {width * height}")
+        flat = np.repeat(np.arange(runs.size, dtype=np.uint8) % 2, runs)
+    else:
+        raise ValueError(f"Unknown mask encoding: {encoding}")
+    return flat.reshape(height, width) * np.uint8(255)
@@ -6,20 +6,17 @@
 #       indir=<path to input data> \
 #       outdir=<where to store predicts>
 
+import contextlib
+import hashlib
 import logging
 import os
 import sys
+import threading
 import traceback
 
 from saicinpainting.evaluation.utils import move_to_device
 from saicinpainting.evaluation.refinement import refine_predict
 
-os.environ['OMP_NUM_THREADS'] = '1'
-os.environ['OPENBLAS_NUM_THREADS'] = '1'
-os.environ['MKL_NUM_THREADS'] = '1'
-os.environ['VECLIB_MAXIMUM_THREADS'] = '1'
-os.environ['NUMEXPR_NUM_THREADS'] = '1'
-
 import cv2
 import hydra
 import numpy as np
@@ -29,35 +26,331 @@
 from omegaconf import OmegaConf
 from torch.utils.data._utils.collate import default_collate
 
+from saicinpainting.evaluation.data import pad_img_to_modulo
 from saicinpainting.training.data.datasets import make_default_val_dataset
 from saicinpainting.training.trainers import load_checkpoint
 from saicinpainting.utils import register_debug_signal_handlers
 
 LOGGER = logging.getLogger(__name__)
 
+# autocast dtypes of the precision setting, fp32 runs without autocast
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def load_model(predict_config):
+    train_config_path = os.path.join(predict_config.model.path, 'config.yaml')
+    with open(train_config_path, 'r') as f:
+        train_config = OmegaConf.create(yaml.safe_load(f))
+
+    train_config.training_model.predict_only = True
+    train_config.visualizer.kind = 'noop'
+
+    checkpoint_path = os.path.join(predict_config.model.path, 'models', predict_config.model.checkpoint)
+    model = load_checkpoint(train_config, checkpoint_path, strict=False, map_location='cpu')
+    model.freeze()
+    if not predict_config.get('refine', False):
+        model.to(torch.device(predict_config.device))
+    return model
+
+
+def make_sample(image, mask, pad_out_to_modulo=None):
+    """
+    Builds the same sample make_default_val_dataset would load from disk, from an RGB image (HxWx3) and a
+    mask (HxW, non-zero marks the hole to fill).
+    """
+    image = np.transpose(np.asarray(image, dtype=np.uint8), (2, 0, 1)).astype('float32') / 255
+    mask = np.asarray(mask, dtype=np.uint8)[None, ...].astype('float32') / 255
+    sample = dict(image=image, mask=mask)
+    if pad_out_to_modulo is not None and pad_out_to_modulo > 1:
+        sample['unpad_to_size'] = image.shape[1:]
+        sample['image'] = pad_img_to_modulo(sample['image'], pad_out_to_modulo)
+        sample['mask'] = pad_img_to_modulo(sample['mask'], pad_out_to_modulo)
+    return sample
+
+
+def pad_to_size(sample, height, width):
+    # pads an already collatable sample further (bottom/right, like pad_img_to_modulo) so samples of different
+    # sizes can share a batch; unpad_to_size keeps the original size
+    sample = dict(sample)
+    sample.setdefault('unpad_to_size', sample['image'].shape[1:])
+    for key in ('image', 'mask'):
+        _, cur_height, cur_width = sample[key].shape
+        sample[key] = np.pad(sample[key], ((0, 0), (0, height - cur_height), (0, width - cur_width)), mode='symmetric')
+    return sample
+
+
+def collate_padded(samples):
+    # one batch from samples of possibly different sizes, the smaller ones padded to the largest (see pad_to_size)
+    if len(samples) > 1:
+        height = max(sample['image'].shape[1] for sample in samples)
+        width = max(sample['image'].shape[2] for sample in samples)
+        samples = [pad_to_size(sample, height, width) for sample in samples]
+    return default_collate(samples)
+
+
+def to_uint8(cur_res):
+    return np.clip(cur_res * 255, 0, 255).astype('uint8')
+
+
+def sample_to_arrays(sample):
+    # inverse of make_sample: the unpadded uint8 RGB image and mask of a dataset sample
+    height, width = sample.get('unpad_to_size', sample['image'].shape[1:])
+    image = np.transpose(sample['image'][:, :height, :width], (1, 2, 0))
+    mask = sample['mask'][0, :height, :width]
+    return to_uint8(image), (mask > 0).astype(np.uint8) * np.uint8(255)
+
+
+def _grow_span(start, stop, margin, modulo, size):
+    start, stop = max(0, start - margin), min(size, stop + margin)
+    length = min(size, -(-(stop - start) // modulo) * modulo)
+    # grow evenly on both sides, shifted back inside the image where it would cross an edge
+    start = min(max(0, start - (length - (stop - start)) // 2), size - length)
+    return start, start + length
+
+
+def roi_window(mask, margin, modulo=None):
+    """
+    Context window (top, bottom, left, right) around the hole of mask: the bounding box of its non-zero pixels
+    grown by margin on every side, then to a multiple of modulo as far as the image allows. Returns None for an
+    empty mask.
+    """
+    mask = np.asarray(mask)
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    modulo = modulo if modulo is not None and modulo > 1 else 1
+    top, bottom = _grow_span(int(rows[0]), int(rows[-1]) + 1, margin, modulo, mask.shape[0])
+    left, right = _grow_span(int(cols[0]), int(cols[-1]) + 1, margin, modulo, mask.shape[1])
+    return top, bottom, left, right
+
+
+def crop_to_window(array, window):
+    top, bottom, left, right = window
+    return np.asarray(array)[top:bottom, left:right]
+
+
+def paste_window(image, patch, window):
+    top, bottom, left, right = window
+    image = np.array(image, dtype=np.uint8)
+    image[top:bottom, left:right] = patch
+    return image
+
+
+def blend_upscaled_hole(image, mask, low_res):
+    """
+    Upscales the part of the low resolution result low_res that covers the hole of mask to the size of image and
+    composites it over the hole; every pixel outside the mask stays exactly as in image.
+    """
+    height, width = mask.shape
+    low_height, low_width = low_res.shape[:2]
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return np.array(image)
+    cols = np.flatnonzero(mask.any(axis=0))
+    top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+    # the pixel center mapping of cv2.resize, restricted to the hole's bounding box
+    scale_x, scale_y = low_width / width, low_height / height
+    to_low_res = np.float32([[scale_x, 0, (left + 0.5) * scale_x - 0.5], [0, scale_y, (top + 0.5) * scale_y - 0.5]])
+    patch = cv2.warpAffine(
+        low_res,
+        to_low_res,
+        (int(right - left), int(bottom - top)),
+        flags=cv2.INTER_CUBIC | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_REPLICATE,
+    )
+
+    result = np.array(image)
+    hole = mask[top:bottom, left:right] > 0
+    result[top:bottom, left:right][hole] = patch[hole]
+    return result
+
+
+def fourier_units_in_float32(model):
+    # torch.fft has no reduced precision kernels on CPU and fp16 ones only for power of two sizes on CUDA,
+    # so LaMa's Fourier units keep running in float32 when the rest of the model is autocast
+    for module in model.modules():
+        if type(module).__name__ != 'FourierUnit':
+            continue
+
+        def forward_float32(x, forward=module.forward):
+            with torch.autocast(device_type=x.device.type, enabled=False):
+                return forward(x.float())
+
+        module.forward = forward_float32
+
+
+class LamaEngine:
+    """
+    Keeps the LaMa checkpoint loaded so that every prediction only pays for the forward pass.
+    The engine can be shared between threads; forward passes are serialized on the model.
+
+    With roi_margin set in the config, predict() only runs the model on a window around the hole (see roi_window)
+    and pastes the result back into the untouched image, so a small edit in a large photo costs as much as the
+    window. Pixels outside the window are copied from the input, which matches the full pass for the 'inpainted'
+    out_key; the window only limits how much context LaMa sees.
+
+    With max_resolution set, inputs (or ROI windows) whose longer side exceeds it are inpainted downscaled to that
+    size. Only the hole is upscaled back and composited into the full resolution input (see blend_upscaled_hole),
+    so pixels outside the mask keep their full detail.
+
+    Inference settings, all optional in the config:
+      num_threads: intra-op threads of torch (process wide), torch's default of one per core when unset
+      inference_mode: run under torch.inference_mode instead of torch.no_grad, on by default
+      precision: fp32 (default), bf16 or fp16 autocast; bf16 is the one CPUs support well
+      channels_last: NHWC memory format for the model and its inputs
+      compile: torch.compile the generator (torch 2), compiled for dynamic shapes on the first forward pass
+    """
+
+    def __init__(self, predict_config):
+        self.predict_config = predict_config
+        self.device = torch.device(predict_config.device)
+        self.refine = predict_config.get('refine', False)
+        self.pad_out_to_modulo = predict_config.dataset.get('pad_out_to_modulo', None)
+        self.roi_margin = predict_config.get('roi_margin', None)
+        self.max_resolution = predict_config.get('max_resolution', None)
+        self.num_threads = predict_config.get('num_threads', None)
+        self.inference_mode = predict_config.get('inference_mode', True)
+        self.precision = predict_config.get('precision', 'fp32')
+        self.channels_last = predict_config.get('channels_last', False)
+        if self.precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {self.precision}, expected one of {list(PRECISIONS)}")
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+
+        self.model = load_model(predict_config)
+        if not self.refine:
+            self.optimize_model(predict_config.get('compile', False))
+        self.lock = threading.Lock()
+
+    def optimize_model(self, compile_model=False):
+        if self.channels_last:
+            self.model.to(memory_format=torch.channels_last)
+        if self.precision != 'fp32':
+            fourier_units_in_float32(self.model)
+        if compile_model:
+            if not hasattr(torch, 'compile'):
+                raise ValueError(f"compile needs torch 2, this is torch {torch.__version__}")
+            if hasattr(self.model, 'generator'):
+                self.model.generator = torch.compile(self.model.generator, dynamic=True)
+            else:
+                self.model = torch.compile(self.model, dynamic=True)
+
+    def fingerprint(self):
+        # identifies the checkpoint and the settings that change results, e.g. to keep cached results apart
+        config = self.predict_config
+        checkpoint_path = os.path.abspath(os.path.join(config.model.path, 'models', config.model.checkpoint))
+        try:
+            stat = os.stat(checkpoint_path)
+            checkpoint = (checkpoint_path, stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            checkpoint = (checkpoint_path,)
+        settings = (
+            checkpoint,
+            config.out_key,
+            self.refine,
+            self.pad_out_to_modulo,
+            self.roi_margin,
+            self.max_resolution,
+            self.precision,
+        )
+        return hashlib.blake2b(repr(settings).encode(), digest_size=8).hexdigest()
+
+    def inference_context(self):
+        context = contextlib.ExitStack()
+        context.enter_context(torch.inference_mode() if self.inference_mode else torch.no_grad())
+        if self.precision != 'fp32':
+            context.enter_context(torch.autocast(device_type=self.device.type, dtype=PRECISIONS[self.precision]))
+        return context
+
+    def warmup(self, size=256):
+        # the first forward pass pays for cudnn autotuning and allocator growth, do it before serving
+        image = np.zeros((size, size, 3), dtype=np.uint8)
+        mask = np.zeros((size, size), dtype=np.uint8)
+        mask[size // 4 : size * 3 // 4, size // 4 : size * 3 // 4] = 255
+        self.predict(image, mask)
+
+    def predict_batch(self, batch):
+        # returns the inpainted images of a collated batch as float HxWx3 arrays in [0, 1], unpadded
+        if self.refine:
+            assert 'unpad_to_size' in batch, "Unpadded size is required for the refinement"
+            # image unpadding is taken care of in the refiner, so that output image
+            # is same size as the input image
+            with self.lock:
+                cur_res = refine_predict(batch, self.model, **self.predict_config.refiner)
+            return [res.permute(1, 2, 0).detach().cpu().numpy() for res in cur_res]
+
+        with self.lock, self.inference_context():
+            batch = move_to_device(batch, self.device)
+            batch['mask'] = (batch['mask'] > 0) * 1
+            if self.channels_last:
+                for key in ('image', 'mask'):
+                    batch[key] = batch[key].contiguous(memory_format=torch.channels_last)
+            batch = self.model(batch)
+            results = batch[self.predict_config.out_key].float().permute(0, 2, 3, 1).detach().cpu().numpy()
+        unpad_to_size = batch.get('unpad_to_size', None)
+        if unpad_to_size is not None:
+            orig_height, orig_width = unpad_to_size
+            results = [res[: int(orig_height[i]), : int(orig_width[i])] for i, res in enumerate(results)]
+        return list(results)
+
+    def prepare(self, image, mask):
+        """
+        Applies the ROI and resolution policies to an (image, mask) pair. Returns the image and mask to run the
+        model on, and a function turning the model's uint8 result back into the full size inpainted image.
+        """
+        image = np.asarray(image, dtype=np.uint8)
+        mask = np.asarray(mask, dtype=np.uint8)
+        height, width = mask.shape
+        window = roi_window(mask, self.roi_margin, self.pad_out_to_modulo) if self.roi_margin is not None else None
+        if window is None:
+            window = (0, height, 0, width)
+        crop_image, crop_mask = crop_to_window(image, window), crop_to_window(mask, window)
+        crop_height, crop_width = crop_mask.shape
+
+        work_height, work_width = crop_height, crop_width
+        if self.max_resolution is not None and max(crop_height, crop_width) > self.max_resolution:
+            scale = self.max_resolution / max(crop_height, crop_width)
+            work_height, work_width = max(1, round(crop_height * scale)), max(1, round(crop_width * scale))
+        downscaled = (work_height, work_width) != (crop_height, crop_width)
+        if window == (0, height, 0, width) and not downscaled:
+            return image, mask, lambda cur_res: cur_res
+
+        model_image, model_mask = crop_image, crop_mask
+        if downscaled:
+            model_image = cv2.resize(crop_image, (work_width, work_height), interpolation=cv2.INTER_AREA)
+            # a low resolution pixel is part of the hole if any pixel it covers is
+            model_mask = cv2.resize(crop_mask, (work_width, work_height), interpolation=cv2.INTER_AREA)
+            model_mask = (model_mask > 0).astype(np.uint8) * np.uint8(255)
+
+        def finish(cur_res):
+            if downscaled:
+                cur_res = blend_upscaled_hole(crop_image, crop_mask, cur_res)
+            return paste_window(image, cur_res, window)
+
+        return model_image, model_mask, finish
+
+    def predict(self, image, mask):
+        """
+        Inpaints the non-zero region of mask in image. Both are arrays (or PIL images) of the same size;
+        returns the inpainted RGB image as a uint8 HxWx3 array.
+        """
+        image, mask, finish = self.prepare(image, mask)
+        batch = default_collate([make_sample(image, mask, self.pad_out_to_modulo)])
+        return finish(to_uint8(self.predict_batch(batch)[0]))
+
 
 # @hydra.main(config_path='../configs/prediction', config_name='web_server.yaml')
-def main(predict_config: dict):
+def main(predict_config: dict, engine=None):
     try:
         # register_debug_signal_handlers()  # kill -10 <pid> will result in traceback dumped into log
 
-        device = torch.device(predict_config.device)
-
-        train_config_path = os.path.join(predict_config.model.path, 'config.yaml')
-        with open(train_config_path, 'r') as f:
-            train_config = OmegaConf.create(yaml.safe_load(f))
-
-        train_config.training_model.predict_only = True
-        train_config.visualizer.kind = 'noop'
+        if engine is None:
+            engine = LamaEngine(predict_config)
 
         out_ext = predict_config.get('out_ext', '.png')
 
-        checkpoint_path = os.path.join(predict_config.model.path, 'models', predict_config.model.checkpoint)
-        model = load_checkpoint(train_config, checkpoint_path, strict=False, map_location='cpu')
-        model.freeze()
-        if not predict_config.get('refine', False):
-            model.to(device)
-
         if not predict_config.indir.endswith('/'):
             predict_config.indir += '/'
 
@@ -68,25 +361,10 @@ def main(predict_config: dict):
                 predict_config.outdir, os.path.splitext(mask_fname[len(predict_config.indir) :])[0] + out_ext
             )
             os.makedirs(os.path.dirname(cur_out_fname), exist_ok=True)
-            batch = default_collate([dataset[img_i]])
-            if predict_config.get('refine', False):
-                assert 'unpad_to_size' in batch, "Unpadded size is required for the refinement"
-                # image unpadding is taken care of in the refiner, so that output image
-                # is same size as the input image
-                cur_res = refine_predict(batch, model, **predict_config.refiner)
-                cur_res = cur_res[0].permute(1, 2, 0).detach().cpu().numpy()
+            if engine.roi_margin is None and engine.max_resolution is None:
+                cur_res = to_uint8(engine.predict_batch(default_collate([dataset[img_i]]))[0])
             else:
-                with torch.no_grad():
-                    batch = move_to_device(batch, device)
-                    batch['mask'] = (batch['mask'] > 0) * 1
-                    batch = model(batch)
-                    cur_res = batch[predict_config.out_key][0].permute(1, 2, 0).detach().cpu().numpy()
-                    unpad_to_size = batch.get('unpad_to_size', None)
-                    if unpad_to_size is not None:
-                        orig_height, orig_width = unpad_to_size
-                        cur_res = cur_res[:orig_height, :orig_width]
-
-            cur_res = np.clip(cur_res * 255, 0, 255).astype('uint8')
+                cur_res = engine.predict(*sample_to_arrays(dataset[img_i]))
             cur_res = cv2.cvtColor(cur_res, cv2.COLOR_RGB2BGR)
             cv2.imwrite(cur_out_fname, cur_res)
 
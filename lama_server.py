@@ -1,14 +1,34 @@
-from flask import Flask, send_file, request
+from flask import Flask, Response, abort, jsonify, send_file, request
+from werkzeug.wsgi import ClosingIterator
+import _thread
+import argparse
 import base64
-from PIL import Image
 import io
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
-from lama_predict import main as lama_predict
+import lama_codec
+from inpaint_cache import InpaintCache
+from lama_batching import BatchScheduler
+from lama_predict import LamaEngine
 
 import os
 import yaml
 from omegaconf import OmegaConf
 
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = object
+
 cwd = os.getcwd()
 print(cwd)
 
@@ -17,66 +37,308 @@
     config = OmegaConf.create(yaml.safe_load(f))
 
 config.model.path = os.path.join(cwd, "big-lama")
-config.indir = os.path.join(cwd, "web_server_input")
-config.outdir = os.path.join(cwd, "web_server_output")
 config.refine = False
 
+engine = None
+scheduler = None
+cache = None
+# set once the model is loaded and warmed up, the server listens (and answers /healthz) before that
+ready = threading.Event()
+load_error = None
+# seconds a request may wait for its inpainted image, None waits forever
+request_timeout = None
+in_flight = 0
+in_flight_lock = threading.Lock()
+
+# every request decodes into its own buffers and the engine serializes access to the model,
+# so the server can handle requests from several users concurrently
 app = Flask(__name__)
 
 
+def count_in_flight(wsgi_app):
+    # a request counts until its response body is consumed, so a graceful shutdown doesn't cut off large images
+    def add(count):
+        global in_flight
+        with in_flight_lock:
+            in_flight += count
+
+    def counted(environ, start_response):
+        add(1)
+        try:
+            return ClosingIterator(wsgi_app(environ, start_response), lambda: add(-1))
+        except BaseException:
+            add(-1)
+            raise
+
+    return counted
+
+
+app.wsgi_app = count_in_flight(app.wsgi_app)
+
+
+def inpaint(image, mask):
+    if not ready.is_set():
+        abort(503, "The model is still loading")
+    if image.ndim != 3 or image.shape[2] != 3 or mask.shape != image.shape[:2]:
+        abort(400, f"Mask size {mask.shape[::-1]} does not match image size {image.shape[1::-1]}")
+    # identical (image, mask) pairs, e.g. a slider moved back to a previous value, are served from the cache
+    key = cache.key(image, mask)
+    image_inpainted = cache.get(key)
+    if image_inpainted is None:
+        future = scheduler.submit(image, mask)
+        try:
+            image_inpainted = future.result(request_timeout)
+        except FutureTimeoutError:
+            future.cancel()  # only possible while queued, a running batch completes
+            abort(504, f"Inpainting took longer than {request_timeout}s")
+        cache.put(key, image_inpainted)
+    return image_inpainted
+
+
+def decode_image(base64_data, mode):
+    return lama_codec.decode_image(base64.b64decode(base64_data), 'png', mode=mode)
+
+
+def encode_png(image):
+    # lossless either way, a low compression level keeps the encode cheap
+    return io.BytesIO(lama_codec.encode_image(image, 'png', compress_level=1))
+
+
 @app.route("/api/v2/image", methods=["GET", "POST"])
 def echo_image():
     # Get the image data from the request body
     json_dict = request.get_json()
-    print(type(json_dict))
-    # Get the value of the "image" key, which is the base64 encoded image data
-    base64_image_data = json_dict["image"]
-    # print(base64_image_data[0:500])
-
-    image_bytes = base64.b64decode(base64_image_data)
-    image_stream = io.BytesIO(image_bytes)
-    image = Image.open(image_stream)
-    print(image.format_description)
-    if not os.path.exists("web_server_input"):
-        os.makedirs("web_server_input")
-    image.save("web_server_input/server.png")
-
-    base64_mask_data = json_dict["mask"]
-    image_bytes = base64.b64decode(base64_mask_data)
-    image_stream = io.BytesIO(image_bytes)
-    mask = Image.open(image_stream)
-    print(mask.format_description)
-    print(mask.format)
-    print(mask.size)
-    print(mask.mode)
-    if mask.mode != "L":
-        mask = mask.convert("L")
-    if not os.path.exists("web_server_input"):
-        os.makedirs("web_server_input")
-    mask.save("web_server_input/server_mask.png")
-
-    # Apply the mask to the image
-    # Create a new transparent image with the same size and mode as the image
-    transparent = Image.new(image.mode, image.size, (0, 0, 0, 0))
-    # Composite the image and the transparent image using the mask
-    masked_image = Image.composite(image, transparent, mask)
-    masked_image.save("server_masked_image.png")
-
-    # Convert the masked image to bytes and create a new stream
-    masked_image_stream = io.BytesIO()
-    masked_image.save(masked_image_stream, format='PNG')
-    masked_image_stream.seek(0)
-
-    lama_predict(config)
-
-    with open("web_server_output/server_mask.png", "rb") as image_file:
-        image_bytes = image_file.read()
-        image_inpainted_stream = io.BytesIO(image_bytes)
-        print(image.format_description)
-    image_inpainted_stream.seek(0)
-
-    return send_file(image_inpainted_stream, mimetype="image/png")
+    # The "image" and "mask" keys hold base64 encoded PNGs; the mask is non-zero where the image is inpainted
+    image = decode_image(json_dict["image"], "RGB")
+    mask = decode_image(json_dict["mask"], "L")
+
+    image_inpainted = inpaint(image, mask)
+
+    return send_file(encode_png(image_inpainted), mimetype="image/png")
+
+
+@app.route("/api/v3/image", methods=["POST"])
+def inpaint_image():
+    """
+    Binary variant of /api/v2/image without base64 or JSON. Either a multipart/form-data body with "image" and
+    "mask" file fields, or a raw body holding the image bytes followed by the mask bytes (the "image_size"
+    parameter gives the split). Parameters come from the form fields or the query string:
+      image_format: png (default) or raw RGB pixels, which needs width and height
+      mask_encoding: bits (default, 1 bit per pixel), rle or png; non-zero marks the hole
+      response_format: png (default) or raw RGB pixels, sized by the X-Width and X-Height headers
+    """
+    if request.files:
+        params = request.form
+        image_data = request.files["image"].read()
+        mask_data = request.files["mask"].read()
+    else:
+        params = request.args
+        body = request.get_data()
+        image_size = params.get("image_size", type=int)
+        if image_size is None:
+            abort(400, "A raw body needs the image_size parameter")
+        image_data, mask_data = body[:image_size], body[image_size:]
+
+    image_format = params.get("image_format", "png")
+    mask_encoding = params.get("mask_encoding", "bits")
+    response_format = params.get("response_format", "png")
+    if image_format not in lama_codec.IMAGE_FORMATS or mask_encoding not in lama_codec.MASK_ENCODINGS:
+        abort(400, f"Unsupported image_format {image_format} or mask_encoding {mask_encoding}")
+    if response_format not in lama_codec.IMAGE_FORMATS:
+        abort(400, f"Unsupported response_format {response_format}")
+
+    try:
+        image = lama_codec.decode_image(
+            image_data, image_format, params.get("width", type=int), params.get("height", type=int)
+        )
+        height, width = image.shape[:2]
+        mask = lama_codec.decode_mask(mask_data, mask_encoding, width, height)
+    except (ValueError, TypeError, OSError) as ex:
+        abort(400, f"Could not decode the request: {ex}")
+    if mask.shape != (height, width):
+        abort(400, f"Mask size {mask.shape[::-1]} does not match image size {(width, height)}")
+
+    image_inpainted = inpaint(image, mask)
+
+    if response_format == "raw":
+        return Response(
+            lama_codec.encode_image(image_inpainted, "raw"),
+            mimetype="application/octet-stream",
+            headers={"X-Width": str(width), "X-Height": str(height)},
+        )
+    return send_file(encode_png(image_inpainted), mimetype="image/png")
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if not ready.is_set():
+        abort(503, "The model is still loading")
+    return jsonify({"scheduler": scheduler.stats(), "cache": cache.stats()})
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"status": "ok"})
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    # answers for the process that took the request, with gunicorn every worker loads its own model
+    if ready.is_set():
+        return jsonify({"status": "ready", "pid": os.getpid()})
+    if load_error is not None:
+        return jsonify({"status": "failed", "error": load_error, "pid": os.getpid()}), 503
+    return jsonify({"status": "loading", "pid": os.getpid()}), 503
+
+
+def load_engine(args):
+    global engine, scheduler, cache
+
+    config.roi_margin = args.roi_margin
+    config.max_resolution = args.max_resolution or None
+    config.num_threads = args.num_threads
+    config.precision = args.precision
+    config.channels_last = args.channels_last
+    config.compile = args.compile
+    # load the model once, every request only runs the forward pass
+    engine = LamaEngine(config)
+    engine.warmup()
+    # requests arriving within max_wait_ms of each other share one forward pass
+    scheduler = BatchScheduler(engine, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    # the disk cache outlives restarts, entries of another checkpoint or other settings must not match
+    cache = InpaintCache(
+        max_bytes=args.cache_mb * 2**20,
+        disk_dir=args.cache_dir,
+        max_disk_bytes=args.cache_disk_mb * 2**20,
+        namespace=engine.fingerprint(),
+    )
+    ready.set()
+
+
+def load_engine_in_background(args):
+    def load():
+        global load_error
+        try:
+            load_engine(args)
+        except Exception as ex:
+            load_error = f"{type(ex).__name__}: {ex}"
+            traceback.print_exc()
+
+    threading.Thread(target=load, name="lama-loader", daemon=True).start()
+
+
+def serve_waitress(args):
+    # one process, args.threads request threads sharing the model
+    server = waitress.create_server(
+        app, host=args.host, port=args.port, threads=args.threads, channel_timeout=args.request_timeout
+    )
+    shutting_down = threading.Event()
+
+    def busy():
+        # running requests, or responses still being written to their connections
+        channels = list(server._map.values())
+        return in_flight > 0 or any(getattr(channel, 'total_outbufs_len', 0) > 0 for channel in channels)
+
+    def drain():
+        deadline = time.monotonic() + args.shutdown_timeout
+        while busy() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if in_flight > 0:
+            print(f"Shutting down with {in_flight} request(s) still running")
+        _thread.interrupt_main()
+
+    def shutdown(signum, frame):
+        if shutting_down.is_set():
+            # drained, or a second Ctrl+C: ends server.run(), which then stops the request threads
+            raise KeyboardInterrupt
+        shutting_down.set()
+        print("Shutting down: not accepting new connections, finishing running requests")
+        # closing the listening socket here could pull it from under the server's select()
+        server.accepting = False
+        threading.Thread(target=drain, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    load_engine_in_background(args)
+    server.run()
+
+
+class GunicornServer(BaseApplication):
+    # args.workers processes with args.threads request threads each; every process loads its own model
+    def __init__(self, args):
+        self.args = args
+        super().__init__()
+
+    def load_config(self):
+        self.cfg.set("bind", f"{self.args.host}:{self.args.port}")
+        self.cfg.set("workers", self.args.workers)
+        self.cfg.set("threads", self.args.threads)
+        self.cfg.set("worker_class", "gthread")
+        # a worker silent for this long is restarted, the model load happens in the background so it doesn't count
+        self.cfg.set("timeout", int(self.args.request_timeout) + 30)
+        self.cfg.set("graceful_timeout", int(self.args.shutdown_timeout))
+        self.cfg.set("post_fork", lambda server, worker: load_engine_in_background(self.args))
+
+    def load(self):
+        return app
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port=9171)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9171)
+    parser.add_argument(
+        "--server",
+        type=str,
+        default="waitress" if waitress is not None else "flask",
+        choices=["waitress", "gunicorn", "flask"],
+        help="flask is the development server, gunicorn is needed for --workers",
+    )
+    parser.add_argument("--threads", type=int, default=8, help="request threads per process, sharing its model")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn processes, each loads its own model")
+    parser.add_argument("--request-timeout", type=float, default=120.0, help="seconds a request may take")
+    parser.add_argument(
+        "--shutdown-timeout", type=float, default=30.0, help="seconds running requests get to finish on shutdown"
+    )
+    parser.add_argument("--debug", action="store_true", help="the flask debugger, only with --server flask")
+    parser.add_argument("--max-batch-size", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    parser.add_argument("--cache-mb", type=int, default=512, help="memory budget of the inpaint result cache")
+    parser.add_argument("--cache-dir", type=str, default=None, help="also keep cached results on disk here")
+    parser.add_argument("--cache-disk-mb", type=int, default=2048)
+    parser.add_argument(
+        "--roi-margin",
+        type=int,
+        default=None,
+        help="only inpaint a window this many pixels around the hole instead of the whole image",
+    )
+    parser.add_argument(
+        "--max-resolution",
+        type=int,
+        default=2048,
+        help="inpaint larger images downscaled to this longer side and upscale only the hole (0 to disable)",
+    )
+    parser.add_argument(
+        "--num-threads", type=int, default=None, help="torch threads per process, one per core by default"
+    )
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"])
+    parser.add_argument("--channels-last", action="store_true", help="run the model in the NHWC memory format")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the model (torch 2)")
+    args = parser.parse_args()
+    request_timeout = args.request_timeout
+
+    if args.server == "waitress" and waitress is None:
+        parser.error("--server waitress needs the waitress package (pip install waitress)")
+    if args.server == "gunicorn" and BaseApplication is object:
+        parser.error("--server gunicorn needs the gunicorn package (pip install gunicorn)")
+    if args.workers > 1 and args.server != "gunicorn":
+        parser.error("--workers needs --server gunicorn")
+
+    if args.server == "waitress":
+        serve_waitress(args)
+    elif args.server == "gunicorn":
+        GunicornServer(args).run()
+    else:
+        load_engine_in_background(args)
+        # the reloader would start a second process that loads the model again
+        app.run(host=args.host, port=args.port, debug=args.debug, use_reloader=False, threaded=True)
@@ -1,8 +1,10 @@
 import argparse
-import base64
-import io
+import itertools
 import os
-import sys
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import cv2
 import gradio as gr
@@ -11,20 +13,34 @@
 from functools import partial
 from PIL import Image, ImageOps
 
-sys.path.append(os.path.join(os.environ['LLAVA_INTERACTIVE_HOME'], 'GLIGEN/demo'))
-import GLIGEN.demo.app as GLIGEN
-
-sys.path.append(os.path.join(os.environ['LLAVA_INTERACTIVE_HOME'], 'SEEM/demo_code'))
-import SEEM.demo_code.app as SEEM  # must import GLIGEN_app before this. Otherwise, it will hit a protobuf error
-
-sys.path.append(os.path.join(os.environ['LLAVA_INTERACTIVE_HOME'], 'LLaVA'))
-import LLaVA.llava.serve.gradio_web_server as LLAVA
-from LLaVA.llava.utils import (
-    ModerationOptions,
-    does_image_violate_azure_content_safety,
-    does_text_violate_azure_content_safety,
-    violates_guardlist_moderation,
+from backend_loader import Backend, BackendLoader, module_constants
+from backend_scheduler import BATCH, INTERACTIVE, BackendScheduler, Superseded
+from compose_layers import SegmentIndex, dilate_by_distance, label_mask, mask_distance
+from lama_client import LamaClient
+from session_store import SESSION_KEY, SessionStore
+
+LLAVA_INTERACTIVE_HOME = os.environ['LLAVA_INTERACTIVE_HOME']
+
+# importing a backend loads its models, so the imports run in the background while the UI is already up
+backends = BackendLoader(
+    [
+        Backend('GLIGEN', os.path.join(LLAVA_INTERACTIVE_HOME, 'GLIGEN/demo'), ['GLIGEN.demo.app']),
+        # must import GLIGEN_app before this. Otherwise, it will hit a protobuf error
+        Backend('SEEM', os.path.join(LLAVA_INTERACTIVE_HOME, 'SEEM/demo_code'), ['SEEM.demo_code.app']),
+        Backend(
+            'LLaVA',
+            os.path.join(LLAVA_INTERACTIVE_HOME, 'LLaVA'),
+            ['LLaVA.llava.serve.gradio_web_server', 'LLaVA.llava.utils'],
+        ),
+    ]
 )
+GLIGEN = backends.module('GLIGEN', 'GLIGEN.demo.app')
+SEEM = backends.module('SEEM', 'SEEM.demo_code.app')
+LLAVA = backends.module('LLaVA', 'LLaVA.llava.serve.gradio_web_server')
+LLAVA_UTILS = backends.module('LLaVA', 'LLaVA.llava.utils')
+
+# all the page itself needs from GLIGEN, read from its source so building the UI doesn't wait for the import
+GLIGEN_PAGE = module_constants(os.path.join(LLAVA_INTERACTIVE_HOME, 'GLIGEN/demo/app.py'), ['css', 'rescale_js'])
 
 
 class ImageMask(gr.components.Image):
@@ -55,6 +71,17 @@ def preprocess(self, x):
         return super().preprocess(x)
 
 
+# mask dilation changes are only inpainted once the slider has rested this long
+INPAINT_DEBOUNCE_SECONDS = 0.4
+inpaint_request_ids = itertools.count(1)
+generate_job_ids = itertools.count(1)
+
+# memory budget of the compose, shared and gligen states; handlers taking them are wrapped with sessions.track
+sessions = SessionStore()
+
+# model calls and CPU-heavy UI handlers run in per-backend pools, fair across sessions; sized from the command line
+scheduler = BackendScheduler({'SEEM': 1, 'LaMa': 4, 'GLIGEN': 1, 'LLaVA': 4, 'CPU': os.cpu_count() or 4})
+
 css = """
 #compose_btn {
     --tw-border-opacity: 1;
@@ -69,32 +96,16 @@ def preprocess(self, x):
 """
 
 
-def get_bounding_box(img):
-    # Get the indices of all non-zero pixels
-    if np.any(img) == False:  # protect agaist an empty img
-        return None
-    non_zero_indices = np.nonzero(img)
-
-    # Get the minimum and maximum indices for each axis
-    min_x = np.min(non_zero_indices[1])
-    max_x = np.max(non_zero_indices[1])
-    min_y = np.min(non_zero_indices[0])
-    max_y = np.max(non_zero_indices[0])
-
-    # Return the bounding box as a tuple of (min_x, min_y, max_x, max_y)
-    return (min_x, min_y, max_x, max_y)
-
-
-def composite_all_layers(base, objects):  # debugging use only
-    img = base.copy()
-    for obj in objects:
-        for i in range(obj['img'].shape[0]):
-            for j in range(obj['img'].shape[1]):
-                if obj['img'][i, j, 3] != 0:
-                    img[i, j] = obj['img'][i, j]
+def composite_all_layers(state):  # debugging use only
+    img = state['orignal_segmented'].copy()
+    img[state['segment_index'].mask([obj['id'] for obj in state['changed_objects']]) > 0] = 0
+    for obj in state['changed_objects']:
+        obj['layer'].paste_into(img)
     return img
 
 
+@sessions.track
+@scheduler.uses('CPU', priority=INTERACTIVE)
 def changed_objects_handler(mask_dilate_slider, state, evt: gr.SelectData):
     state['move_no'] += 1
 
@@ -102,30 +113,23 @@ def changed_objects_handler(mask_dilate_slider, state, evt: gr.SelectData):
     obj_id = 255 - evt.value
     print(f"obj {obj_id} moved by {pos_x}, {pos_y}")
 
-    img = state['base_layer']
+    layer = None
     for obj in state['changed_objects']:
         if obj['id'] == obj_id:
-            img = obj['img']
+            layer = obj['layer']
             state['changed_objects'].remove(obj)
             break
+    if layer is None:
+        # first move, lift the object off the original segmented image
+        layer = state['segment_index'].layer(state['orignal_segmented'], obj_id)
 
-    new_img = np.zeros_like(img)
-    bbox = None
-    for i in range(img.shape[0]):
-        for j in range(img.shape[1]):
-            if img[i, j, 3] == obj_id:
-                new_i = i + pos_y
-                new_j = j + pos_x
-                if new_i >= 0 and new_i < img.shape[0] and new_j >= 0 and new_j < img.shape[1]:
-                    new_img[new_i, new_j] = img[i, j]
-                img[i, j] = 0
-
-    bbox = get_bounding_box(new_img)  # returns None if obj moved out of scene
+    layer.move(pos_x, pos_y)
+    bbox = layer.bbox()  # returns None if obj moved out of scene
     print("bbox: ", bbox)
-    state['changed_objects'].append({'id': obj_id, 'img': new_img, 'text': state['segment_info'][obj_id], 'box': bbox})
+    state['changed_objects'].append({'id': obj_id, 'layer': layer, 'text': state['segment_info'][obj_id], 'box': bbox})
 
     # Enable for debugging only. See if the composited image is correct.
-    # composed_img_updated = composite_all_layers(state['base_layer'], state['changed_objects'])
+    # composed_img_updated = composite_all_layers(state)
     # filename = str(f"composited_imge_{state['move_no']}") + ".png"
     # cv2.imwrite(filename, composed_img_updated[:, :, 0:3])
 
@@ -137,14 +141,18 @@ def get_base_layer_mask(state):
     for obj in state['changed_objects']:
         changed_obj_id.append(obj['id'])
 
-    # union of mask of all objects
-    img = state['orignal_segmented']
-    mask = np.zeros(img.shape[:2], dtype=np.uint8)
-    for i in range(img.shape[0]):
-        for j in range(img.shape[1]):
-            if img[i, j, 3] in changed_obj_id:
-                mask[i, j] = 255
+    # union of mask of all objects, updated with just the objects added or removed since the last call
+    mask = state.get('base_layer_mask')
+    if mask is None:
+        mask = np.zeros(state['orignal_segmented'].shape[:2], dtype=np.uint8)
+        state['base_layer_mask_ids'] = []
+    if state.get('segment_index') is not None:
+        state['segment_index'].update_mask(mask, state['base_layer_mask_ids'], changed_obj_id)
+    else:
+        mask = label_mask(state['orignal_segmented'][:, :, 3], changed_obj_id)
     state['base_layer_mask'] = mask
+    state['base_layer_mask_ids'] = changed_obj_id
+    state['base_layer_mask_distance'] = None
 
     mask_image = Image.fromarray(mask)
     if mask_image.mode != "L":
@@ -154,7 +162,7 @@ def get_base_layer_mask(state):
 
     img = state['orignal_segmented']
     orig_image = Image.fromarray(img[:, :, :3])
-    orig_image.save("orig_image.png")
+    # orig_image.save("orig_image.png")
     transparent = Image.new(orig_image.mode, orig_image.size, (0, 0, 0, 0))
     masked_image = Image.composite(orig_image, transparent, mask_image)
     # masked_image.save("get_masked_background_image.png")
@@ -162,20 +170,12 @@ def get_base_layer_mask(state):
     return masked_image, state
 
 
-def get_inpainted_background(state, mask_dilate_slider):
-    # Define the URL of the REST API endpoint
-    url = "http://localhost:9171/api/v2/image"
-
+def get_inpainted_background(state, mask_dilate_slider, priority=BATCH):
     img = state['orignal_segmented']
-    if isinstance(img, Image.Image) is not True:
-        img = Image.fromarray(img)
-    # Create a BytesIO object and save the image there
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    # Get the bytes value from the buffer
-    img_bytes = buffer.getvalue()
-
-    encoded_string = base64.b64encode(img_bytes).decode("utf-8")
+    if isinstance(img, Image.Image):
+        img = np.array(img)
+    # the alpha channel only carries segment labels, lama inpaints the RGB image
+    img = img[:, :, :3]
 
     if mask_dilate_slider != 0:
         mask = state['base_layer_mask_enlarged']
@@ -189,52 +189,37 @@ def get_inpainted_background(state, mask_dilate_slider):
         mask = mask.convert("L")
     mask = ImageOps.invert(mask)
 
-    # Create a BytesIO object and save the image there
-    buffer = io.BytesIO()
-    mask.save(buffer, format="PNG")
-    # Get the bytes value from the buffer
-    mask_bytes = buffer.getvalue()
-
-    encoded_string_mask = base64.b64encode(mask_bytes).decode("utf-8")
-
-    # Create a POST request to the endpoint
-    headers = {"Content-Type": "application/json"}
-    data = {"image": encoded_string, "mask": encoded_string_mask}
-    response = requests.post(url, headers=headers, json=data)
-
-    # Check the status code of the response
-    if response.status_code == 200:
-        # The request was successful
+    try:
+        with scheduler.slot('LaMa', state.get(SESSION_KEY), priority):
+            image = Image.fromarray(lama.inpaint(img, np.array(mask)))
         print("Image received successfully")
-        image_data = response.content
-        # Create a io.BytesIO object from the image data
-        dataBytesIO = io.BytesIO(image_data)
-        # Open the image using Image.open()
-        image = Image.open(dataBytesIO)
         # image.save("lama_returned_image.png")
-
-    else:
-        # The request failed
-        print("Error: HTTP status code {}".format(response.status_code))
-        print(response.text)
+    except requests.RequestException as ex:
+        print(f"Error: inpainting request failed: {ex}")
+        raise gr.Error('Inpainting the background failed. Please try again.')
 
     return image
 
 
-def get_enlarged_masked_background(state, mask_dilate_slider):
-    mask = state['base_layer_mask']
-
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (mask_dilate_slider, mask_dilate_slider))
-    mask_dilated = cv2.dilate(mask, kernel)
+def get_enlarged_mask(state, mask_dilate_slider):
+    # one distance transform per base layer mask serves every slider value with a threshold
+    if state.get('base_layer_mask_distance') is None:
+        state['base_layer_mask_distance'] = mask_distance(state['base_layer_mask'])
+    mask_dilated = dilate_by_distance(state['base_layer_mask_distance'], mask_dilate_slider)
 
-    # mask the original
     mask_image = Image.fromarray(mask_dilated)
     if mask_image.mode != "L":
         mask_image = mask_image.convert("L")
     mask_image = ImageOps.invert(mask_image)
-    state['base_layer_mask_enlarged'] = mask_image
     # mask_image.save("enlarged_mask_image.png")
+    return mask_image
+
+
+def get_enlarged_masked_background(state, mask_dilate_slider):
+    mask_image = get_enlarged_mask(state, mask_dilate_slider)
+    state['base_layer_mask_enlarged'] = mask_image
 
+    # mask the original
     img = state['orignal_segmented']
     orig_image = Image.fromarray(img[:, :, :3])
     transparent = Image.new(orig_image.mode, orig_image.size, (0, 0, 0, 0))
@@ -244,13 +229,97 @@ def get_enlarged_masked_background(state, mask_dilate_slider):
     return masked_image, state
 
 
+@sessions.track
+@scheduler.uses('CPU', priority=INTERACTIVE)
+def preview_enlarged_masked_background(state, mask_dilate_slider):
+    # cheap preview while the slider moves, inpainting waits for get_base_layer_inpainted
+    if state.get('base_layer_mask') is None:
+        return gr.update(), state
+    return get_enlarged_masked_background(state, mask_dilate_slider)
+
+
+@sessions.track
 def get_base_layer_inpainted(state, mask_dilate_slider):
+    if state.get('base_layer_mask') is None:
+        return gr.update(), gr.update(), state
+
+    # debounce: only inpaint once the slider has settled, a newer release supersedes this one
+    request_id = next(inpaint_request_ids)
+    state['inpaint_request_id'] = request_id
+    time.sleep(INPAINT_DEBOUNCE_SECONDS)
+    if state['inpaint_request_id'] != request_id:
+        return gr.update(), gr.update(), state
+
+    # pending like the segmentation's inpaint, so a generate pressed meanwhile waits for this dilation's background;
+    # the user is waiting on this one, it goes ahead of the inpaints started by segmentations
+    submit_inpainted_background(state, mask_dilate_slider, priority=INTERACTIVE)
+    # a newer value released while lama is busy takes over, this one returns without waiting for its result
+    inpainted_img, state = wait_inpainted_background(
+        state, superseded=lambda: state['inpaint_request_id'] != request_id
+    )
+    if state['inpaint_request_id'] != request_id:
+        return gr.update(), gr.update(), state
+
     masked_img, state = get_enlarged_masked_background(state, mask_dilate_slider)
-    inpainted_img = get_inpainted_background(state, mask_dilate_slider)
-    state['base_layer_inpainted'] = np.array(inpainted_img)
     return masked_img, inpainted_img, state
 
 
+def submit_inpainted_background(state, mask_dilate_slider, priority=BATCH):
+    # works on a snapshot of the state: the base layer mask is updated in place and the slider preview keeps
+    # replacing the enlarged mask, so both are taken for this dilation now
+    snapshot = dict(
+        state,
+        base_layer_mask=state['base_layer_mask'].copy(),
+        base_layer_mask_enlarged=get_enlarged_mask(state, mask_dilate_slider),
+    )
+    superseded = state.get('base_layer_inpainted_future')
+    state['base_layer_inpainted'] = None
+    # the replacement is in place before the old one is cancelled, its waiters move over to it
+    state['base_layer_inpainted_future'] = start_inpainted_background(snapshot, mask_dilate_slider, priority)
+    if superseded is not None:
+        superseded.cancel()  # no-op if it is already running, its result is ignored
+
+
+def start_inpainted_background(*args):
+    future = inpaint_executor.submit(get_inpainted_background, *args)
+    future.inpaint_args = args  # to start it over if it fails
+    return future
+
+
+@sessions.track
+def wait_inpainted_background(state, superseded=None):
+    # blocks until the session's pending background inpaint is done, following it when a newer one supersedes it;
+    # returns None early once superseded() is true
+    while True:
+        if superseded is not None and superseded():
+            return None, state
+        future = state.get('base_layer_inpainted_future')
+        if future is None:
+            return state.get('base_layer_inpainted'), state
+        try:
+            inpainted_img = future.result(timeout=None if superseded is None else 0.1)
+        except (CancelledError, FutureTimeoutError):
+            continue
+        except Exception:
+            if state.get('base_layer_inpainted_future') is future:
+                # started over right away, so trying again doesn't get this failed result back
+                state['base_layer_inpainted_future'] = start_inpainted_background(*future.inpaint_args)
+            raise
+        if state.get('base_layer_inpainted_future') is future:
+            state['base_layer_inpainted'] = np.array(inpainted_img)
+            state['base_layer_inpainted_future'] = None
+            return state['base_layer_inpainted'], state
+
+
+def start_generate_job(state):
+    # users press generate repeatedly, a newer press supersedes this session's older generations: those still
+    # waiting for GLIGEN leave the queue, those already running have their image dropped
+    job_id = next(generate_job_ids)
+    state['generate_job_id'] = job_id
+    scheduler.wake('GLIGEN')
+    return lambda: state.get('generate_job_id') != job_id
+
+
 def log_image_and_mask(img, mask):  # for debugging use only
     counter = 0
     for filename in os.listdir('.'):
@@ -266,15 +335,19 @@ def log_image_and_mask(img, mask):  # for debugging use only
     cv2.imwrite(f"img_{counter}_mask.png", mask.astype(np.uint8) * 255)
 
 
+@sessions.track
 def get_segments(img, task, reftxt, mask_dilate_slider, state):
     assert isinstance(state, dict)
     state['orignal_segmented'] = None
-    state['base_layer'] = None
     state['base_layer_masked'] = None
     state['base_layer_mask'] = None
+    state['base_layer_mask_ids'] = []
+    state['base_layer_mask_distance'] = None
     state['base_layer_mask_enlarged'] = None
+    # a pending inpaint stays until submit_inpainted_background replaces it, whoever waits on it gets a result
     state['base_layer_inpainted'] = None
     state['segment_info'] = None
+    state['segment_index'] = None
     state['seg_boxes'] = {}
     state['changed_objects'] = []
     state['move_no'] = 0
@@ -286,23 +359,24 @@ def get_segments(img, task, reftxt, mask_dilate_slider, state):
     if isinstance(img['mask'], np.ndarray):
         pil_mask = Image.fromarray(img['mask'])
     img = {'image': pil_image, 'mask': pil_mask}
-    img_ret, seg_info = SEEM.inference(img, task, reftxt=reftxt)
+    with scheduler.slot('SEEM', state.get(SESSION_KEY)):
+        img_ret, seg_info = SEEM.inference(img, task, reftxt=reftxt)
     # SEEM doesn't always respect the input img dimentions
     tgt_size = (img['image'].width, img['image'].height)
     img_ret = img_ret.resize(tgt_size, resample=Image.Resampling.NEAREST)
-    state['orignal_segmented'] = np.array(img_ret).copy()
-    state['base_layer'] = np.array(img_ret)
+    state['orignal_segmented'] = np.array(img_ret)
     state['segment_info'] = seg_info
+    state['segment_index'] = SegmentIndex(state['orignal_segmented'][:, :, 3], seg_info.keys())
     img_ret_array = np.array(img_ret)
     img_ret_array[:, :, 3] = 255 - img_ret_array[:, :, 3]
     # NOTE: if write out as a png, the pixels values get messed up. Same reason the client side colors look weird.
     # cv2.imwrite(f"get_segments_img_ret.bmp", img_ret_array)
+    # results are streamed as they become available: the segmentation, the masked and then the inpainted background
+    yield Image.fromarray(img_ret_array), gr.update(), None, state
 
     for obj_id, lable in seg_info.items():
-        obj_img = img_ret_array[:, :, 3] == 255 - obj_id
-        # cv2.imwrite(f"img_{obj_id}.png", obj_img.astype(np.uint8) * 255)
-        # log_image_and_mask(np.array(img['image']), obj_img)
-        bbox = get_bounding_box(obj_img)
+        # log_image_and_mask(np.array(img['image']), state['segment_index'].mask([obj_id]) > 0)
+        bbox = state['segment_index'].bbox(obj_id)
         print(f"obj_id={obj_id}, lable={lable}, bbox={bbox}")
         state['seg_boxes'][obj_id] = bbox
 
@@ -315,19 +389,28 @@ def get_segments(img, task, reftxt, mask_dilate_slider, state):
     mask_dilate_slider, _, state = changed_objects_handler(mask_dilate_slider, state, evt)
 
     state['base_layer_masked'], state = get_base_layer_mask(state)
-    if mask_dilate_slider != 0:
-        enlarged_masked_background, state = get_enlarged_masked_background(state, mask_dilate_slider)
-    state['base_layer_inpainted'] = np.array(get_inpainted_background(state, mask_dilate_slider))
+    enlarged_masked_background, state = get_enlarged_masked_background(state, mask_dilate_slider)
+    # inpainted in the background, get_generated picks up the pending result if generate is pressed before it's done
+    submit_inpainted_background(state, mask_dilate_slider)
+    yield gr.update(), enlarged_masked_background, gr.update(), state
 
-    return Image.fromarray(img_ret_array), enlarged_masked_background, state['base_layer_inpainted'], state
+    inpainted_background, state = wait_inpainted_background(state)
+    yield gr.update(), gr.update(), inpainted_background, state
 
 
+@sessions.track
 def get_generated(grounding_text, fix_seed, rand_seed, state):
     if ('base_layer_inpainted' in state) == False:
         raise gr.Error('The segmentation step must be completed first before generating a new image')
+    superseded = start_generate_job(state)
 
-    inpainted_background_img = state['base_layer_inpainted']
-    assert inpainted_background_img is not None, 'base layer should be inpainted after segment'
+    inpainted_background_img, state = wait_inpainted_background(state)
+    if inpainted_background_img is None:
+        # get_segments hasn't submitted the inpaint of its new segmentation yet
+        raise gr.Error('The segmentation is still running, please generate once it is done')
+    if superseded():
+        yield gr.update(), state
+        return
 
     state['boxes'] = []
     for items in state['changed_objects']:
@@ -338,7 +421,8 @@ def get_generated(grounding_text, fix_seed, rand_seed, state):
         if len(grounding_text) != 0:
             grounding_text = []
             print("No grounding box found. Grounding text will be ignored.")
-        return inpainted_background_img.copy(), state, None
+        yield inpainted_background_img.copy(), state
+        return
 
     print('Calling GLIGEN_app.generate')
     print('grounding_text: ', grounding_text)
@@ -351,36 +435,49 @@ def get_generated(grounding_text, fix_seed, rand_seed, state):
         does_text_violate_policy = False
 
         if not does_text_violate_policy and (
-            ModerationOptions.ALL.value in args.moderate
-            or ModerationOptions.GLIGEN_INPUT_TEXT_GUARDLIST.value in args.moderate
+            LLAVA_UTILS.ModerationOptions.ALL.value in args.moderate
+            or LLAVA_UTILS.ModerationOptions.GLIGEN_INPUT_TEXT_GUARDLIST.value in args.moderate
         ):
-            does_text_violate_policy |= violates_guardlist_moderation(grounding_text)
+            does_text_violate_policy |= LLAVA_UTILS.violates_guardlist_moderation(grounding_text)
         if not does_text_violate_policy and (
-            ModerationOptions.ALL.value in args.moderate
-            or ModerationOptions.GLIGEN_INPUT_TEXT_AICS.value in args.moderate
+            LLAVA_UTILS.ModerationOptions.ALL.value in args.moderate
+            or LLAVA_UTILS.ModerationOptions.GLIGEN_INPUT_TEXT_AICS.value in args.moderate
         ):
-            does_text_violate_policy |= does_text_violate_azure_content_safety(grounding_text)
+            does_text_violate_policy |= LLAVA_UTILS.does_text_violate_azure_content_safety(grounding_text)
 
         if does_text_violate_policy:
-            return inpainted_background_img.copy(), state
-
-    out_gen_1, _, _, _, state = GLIGEN.generate(
-        task='Grounded Inpainting',
-        language_instruction='',
-        grounding_texts=grounding_text,
-        sketch_pad=inpainted_background_img,
-        alpha_sample=0.3,
-        guidance_scale=7.5,
-        batch_size=1,
-        fix_seed=fix_seed,
-        rand_seed=rand_seed,
-        use_actual_mask=False,
-        append_grounding=True,
-        style_cond_image=None,
-        inpainting_image=inpainted_background_img,
-        inpainting_mask=None,
-        state=state,
-    )
+            yield inpainted_background_img.copy(), state
+            return
+
+    # show the background GLIGEN starts from while it generates
+    yield inpainted_background_img.copy(), state
+
+    try:
+        with scheduler.slot('GLIGEN', state.get(SESSION_KEY), superseded=superseded):
+            out_gen_1, _, _, _, state = GLIGEN.generate(
+                task='Grounded Inpainting',
+                language_instruction='',
+                grounding_texts=grounding_text,
+                sketch_pad=inpainted_background_img,
+                alpha_sample=0.3,
+                guidance_scale=7.5,
+                batch_size=1,
+                fix_seed=fix_seed,
+                rand_seed=rand_seed,
+                use_actual_mask=False,
+                append_grounding=True,
+                style_cond_image=None,
+                inpainting_image=inpainted_background_img,
+                inpainting_mask=None,
+                state=state,
+            )
+    except Superseded:
+        yield gr.update(), state
+        return
+    if superseded():
+        # GLIGEN can't be stopped mid-sampling, but nobody is waiting for this image anymore
+        yield gr.update(), state
+        return
 
     image = out_gen_1['value']
 
@@ -388,17 +485,19 @@ def get_generated(grounding_text, fix_seed, rand_seed, state):
         does_image_violate_policy = False
 
         if not does_image_violate_policy and (
-            ModerationOptions.ALL.value in args.moderate
-            or ModerationOptions.GLIGEN_OUTPUT_IMAGE_AICS.value in args.moderate
+            LLAVA_UTILS.ModerationOptions.ALL.value in args.moderate
+            or LLAVA_UTILS.ModerationOptions.GLIGEN_OUTPUT_IMAGE_AICS.value in args.moderate
         ):
-            does_image_violate_policy |= does_image_violate_azure_content_safety(image)
+            does_image_violate_policy |= LLAVA_UTILS.does_image_violate_azure_content_safety(image)
 
         if does_image_violate_policy:
-            return inpainted_background_img.copy(), state
+            yield inpainted_background_img.copy(), state
+            return
 
-    return image, state
+    yield image, state
 
 
+@sessions.track
 def get_generated_full(
     task,
     language_instruction,
@@ -414,21 +513,28 @@ def get_generated_full(
     style_cond_image,
     state,
 ):
-    out_gen_1, _, _, _, state = GLIGEN.generate(
-        task,
-        language_instruction,
-        grounding_instruction,
-        sketch_pad,
-        alpha_sample,
-        guidance_scale,
-        batch_size,
-        fix_seed,
-        rand_seed,
-        use_actual_mask,
-        append_grounding,
-        style_cond_image,
-        state,
-    )
+    superseded = start_generate_job(state)
+    try:
+        with scheduler.slot('GLIGEN', state.get(SESSION_KEY), superseded=superseded):
+            out_gen_1, _, _, _, state = GLIGEN.generate(
+                task,
+                language_instruction,
+                grounding_instruction,
+                sketch_pad,
+                alpha_sample,
+                guidance_scale,
+                batch_size,
+                fix_seed,
+                rand_seed,
+                use_actual_mask,
+                append_grounding,
+                style_cond_image,
+                state,
+            )
+    except Superseded:
+        return gr.update(), state
+    if superseded():
+        return gr.update(), state
     return out_gen_1['value'], state
 
 
@@ -445,6 +551,7 @@ def clear_sketch_pad_mask(sketch_pad_image):
     return sketch_pad
 
 
+@sessions.track
 def save_shared_state(img, state):
     if isinstance(img, dict) and 'image' in img:
         state['working_image'] = img['image']
@@ -453,6 +560,7 @@ def save_shared_state(img, state):
     return state
 
 
+@sessions.track
 def load_shared_state(state, task=None):
     if task == "Grounded Generation":
         return None
@@ -460,6 +568,7 @@ def load_shared_state(state, task=None):
         return state['working_image']
 
 
+@sessions.track
 def update_shared_state(state, task):
     if task == "Grounded Generation":
         state['working_image'] = None
@@ -472,6 +581,7 @@ def update_sketch_pad_trigger(sketch_pad_trigger, task):
     return sketch_pad_trigger
 
 
+@sessions.track
 def clear_grounding_info(state):
     state['boxes'] = []
     state['masks'] = []
@@ -524,6 +634,91 @@ def copy_to_llava_input(img):
     return img
 
 
+# The backends load in the background (see backends above). Event handlers are bound when the UI is built, so the
+# backend functions are wrapped with their own signatures, which gradio inspects, and resolved on each call.
+gligen_controller = None
+gligen_controller_lock = threading.Lock()
+
+
+def get_gligen_controller():
+    global gligen_controller
+    with gligen_controller_lock:
+        if gligen_controller is None:
+            gligen_controller = GLIGEN.Controller()
+    return gligen_controller
+
+
+def gligen_page_constant(name):
+    return GLIGEN_PAGE[name] if name in GLIGEN_PAGE else getattr(GLIGEN, name)
+
+
+@sessions.track
+@scheduler.uses('CPU', priority=INTERACTIVE)
+def gligen_draw(task, input, grounding_texts, new_image_trigger, state):
+    return GLIGEN.draw(task, input, grounding_texts, new_image_trigger, state)
+
+
+@sessions.track
+def gligen_clear(task, sketch_pad_trigger, batch_size, state, switch_task=False):
+    # GLIGEN.clear starts over with a new state dict, it has to stay in this session's accounting
+    *outputs, new_state = GLIGEN.clear(task, sketch_pad_trigger, batch_size, state, switch_task=switch_task)
+    return (*outputs, sessions.replace_state(state, new_state))
+
+
+def gligen_init_white(init_white_trigger):
+    return get_gligen_controller().init_white(init_white_trigger)
+
+
+@sessions.track
+@scheduler.uses('CPU', priority=INTERACTIVE)
+def gligen_resize_masked(state):
+    return get_gligen_controller().resize_masked(state)
+
+
+def gligen_switch_task_hide_cond(task):
+    return get_gligen_controller().switch_task_hide_cond(task)
+
+
+def llava_load_demo_refresh_model_list(backends_done, request: gr.Request):
+    # runs once per page, when the backends are done loading, so nothing waits on LLaVA until then
+    if not backends_done or not backends.ready('LLaVA'):
+        return gr.update(), gr.update()
+    return LLAVA.load_demo_refresh_model_list(request)
+
+
+def llava_upvote_last_response(state, model_selector, request: gr.Request):
+    return LLAVA.upvote_last_response(state, model_selector, request)
+
+
+def llava_downvote_last_response(state, model_selector, request: gr.Request):
+    return LLAVA.downvote_last_response(state, model_selector, request)
+
+
+def llava_flag_last_response(state, model_selector, request: gr.Request):
+    return LLAVA.flag_last_response(state, model_selector, request)
+
+
+def llava_regenerate(state, image_process_mode, request: gr.Request):
+    return LLAVA.regenerate(state, image_process_mode, request)
+
+
+def llava_clear_history(request: gr.Request):
+    return LLAVA.clear_history(request)
+
+
+def llava_add_text(state, text, image, image_process_mode, request: gr.Request):
+    return LLAVA.add_text(state, text, image, image_process_mode, request)
+
+
+@scheduler.uses('LLaVA')
+def llava_http_bot(state, model_selector, temperature, top_p, max_new_tokens, request: gr.Request):
+    yield from LLAVA.http_bot(state, model_selector, temperature, top_p, max_new_tokens, request)
+
+
+def backend_status():
+    return gr.Markdown.update(value=backends.status_markdown()), backends.done()
+
+
 title_markdown = """
 # 🌋 LLaVA-Interactive
 
@@ -550,23 +745,26 @@ def copy_to_llava_input(img):
 
 
 def build_demo():
-    demo = gr.Blocks(title="🌋 LLaVA-Interactive", css=css + GLIGEN.css)
+    demo = gr.Blocks(title="🌋 LLaVA-Interactive", css=css + gligen_page_constant('css'))
     with demo:
         compose_state = gr.State(
             {
                 'boxes': [],
                 'move_no': 0,
-                'base_layer': None,
+                'orignal_segmented': None,
                 'segment_info': None,
                 'seg_boxes': {},
                 'changed_objects': [],
+                SESSION_KEY: None,
             }
         )
         llava_state = gr.State()
-        shared_state = gr.State({'working_image': None})
-        gligen_state = gr.State({'draw_box': True})
+        shared_state = gr.State({'working_image': None, SESSION_KEY: None})
+        gligen_state = gr.State({'draw_box': True, SESSION_KEY: None})
 
         gr.Markdown(title_markdown)
+        backend_status_markdown = gr.Markdown(backends.status_markdown())
+        backends_done = gr.Checkbox(value=False, visible=False)
 
         gr.Markdown(
             '**Experience interactive multimodal chatting and image manipulation. Select a tab for your task and follow the instructions. Switch tasks anytime and ask questions in the chat window.**'
@@ -703,9 +901,8 @@ def build_demo():
                     use_style_cond = gr.Checkbox(value=False, label="Enable Style Condition", visible=False)
                     style_cond_image = gr.Image(type="pil", label="Style Condition", visible=False, interactive=False)
 
-                controller = GLIGEN.Controller()
                 sketch_pad.edit(
-                    GLIGEN.draw,
+                    gligen_draw,
                     inputs=[task, sketch_pad, grounding_instruction, sketch_pad_resize_trigger, gligen_state],
                     outputs=[out_imagebox, sketch_pad_resize_trigger, image_scale, gligen_state],
                     queue=False,
@@ -713,16 +910,16 @@ def build_demo():
                 llava_image = gr.Image(label='sketch_pad_image', type='pil', visible=False, interactive=False)
                 working_image.change(copy_to_llava_input, [working_image], [llava_image])
                 sketch_pad.upload(save_shared_state, inputs=[sketch_pad, shared_state], outputs=shared_state).then(
-                    load_shared_state, [shared_state], working_image
+                    load_shared_state, [shared_state], working_image, queue=False
                 )
                 grounding_instruction.change(
-                    GLIGEN.draw,
+                    gligen_draw,
                     inputs=[task, sketch_pad, grounding_instruction, sketch_pad_resize_trigger, gligen_state],
                     outputs=[out_imagebox, sketch_pad_resize_trigger, image_scale, gligen_state],
                     queue=False,
                 )
                 gligen_clear_btn.click(
-                    GLIGEN.clear,
+                    gligen_clear,
                     inputs=[task, sketch_pad_trigger, batch_size, gligen_state],
                     outputs=[sketch_pad, sketch_pad_trigger, out_imagebox, image_scale, gligen_state],
                     queue=False,
@@ -732,7 +929,7 @@ def build_demo():
                     update_sketch_pad_trigger, [sketch_pad_trigger, task], sketch_pad_trigger
                 )
                 task.change(
-                    partial(GLIGEN.clear, switch_task=True),
+                    partial(gligen_clear, switch_task=True),
                     inputs=[task, sketch_pad_trigger, batch_size, gligen_state],
                     outputs=[sketch_pad, sketch_pad_trigger, out_imagebox, image_scale, gligen_state],
                     queue=False,
@@ -742,13 +939,16 @@ def build_demo():
                     clear_grounding_info, gligen_state, [gligen_state, grounding_instruction]
                 )
                 sketch_pad_trigger.change(
-                    controller.init_white,
+                    gligen_init_white,
                     inputs=[init_white_trigger],
                     outputs=[sketch_pad, image_scale, init_white_trigger],
                     queue=False,
                 )
                 sketch_pad_resize_trigger.change(
-                    controller.resize_masked, inputs=[gligen_state], outputs=[sketch_pad, gligen_state], queue=False
+                    gligen_resize_masked,
+                    inputs=[gligen_state],
+                    outputs=[sketch_pad, gligen_state],
+                    queue=False,
                 )
 
                 gligen_gen_btn.click(
@@ -770,19 +970,21 @@ def build_demo():
                     ],
                     outputs=[sketch_pad, gligen_state],
                     queue=True,
-                ).then(save_shared_state, [sketch_pad, shared_state], shared_state).then(
-                    load_shared_state, [shared_state], working_image
+                ).then(save_shared_state, [sketch_pad, shared_state], shared_state, queue=False).then(
+                    load_shared_state, [shared_state], working_image, queue=False
                 )
 
                 sketch_pad_resize_trigger.change(
-                    None, None, sketch_pad_resize_trigger, _js=GLIGEN.rescale_js, queue=False
+                    None, None, sketch_pad_resize_trigger, _js=gligen_page_constant('rescale_js'), queue=False
+                )
+                init_white_trigger.change(
+                    None, None, init_white_trigger, _js=gligen_page_constant('rescale_js'), queue=False
                 )
-                init_white_trigger.change(None, None, init_white_trigger, _js=GLIGEN.rescale_js, queue=False)
                 use_style_cond.change(
                     lambda cond: gr.Image.update(visible=cond), use_style_cond, style_cond_image, queue=False
                 )
                 task.change(
-                    controller.switch_task_hide_cond,
+                    gligen_switch_task_hide_cond,
                     inputs=task,
                     outputs=[use_style_cond, style_cond_image, alpha_sample, use_actual_mask],
                     queue=False,
@@ -836,10 +1038,19 @@ def build_demo():
             outputs=[segmented_img, masked_background_img, inpainted_background_img, compose_state],
             queue=True,
         )
+        # cheap interactive handlers skip the queue, so they don't wait behind generations; the model calls of the
+        # queued ones are limited per backend by the scheduler
         segmented_img.select(
             changed_objects_handler,
             [mask_dilate_slider, compose_state],
             [mask_dilate_slider, masked_background_img, compose_state],
+            queue=False,
+        )
+        mask_dilate_slider.change(
+            preview_enlarged_masked_background,
+            inputs=[compose_state, mask_dilate_slider],
+            outputs=[masked_background_img, compose_state],
+            queue=False,
         )
         mask_dilate_slider.release(
             get_base_layer_inpainted,
@@ -851,18 +1062,18 @@ def build_demo():
             [grounding_text_box, compose_fix_seed, compose_rand_seed, compose_state],
             [sketch_pad, compose_state],
             queue=True,
-        ).then(save_shared_state, [sketch_pad, shared_state], shared_state).then(
-            load_shared_state, [shared_state], working_image
+        ).then(save_shared_state, [sketch_pad, shared_state], shared_state, queue=False).then(
+            load_shared_state, [shared_state], working_image, queue=False
         )
-        compose_clear_btn.click(load_shared_state, [shared_state], sketch_pad)
+        compose_clear_btn.click(load_shared_state, [shared_state], sketch_pad, queue=False)
 
         image_process_mode = gr.Radio(
             ["Crop", "Resize", "Pad"], value="Crop", label="Preprocess for non-square image", visible=False
         )
-        models = LLAVA.get_model_list(args)
+        # filled in by llava_load_demo_refresh_model_list once LLaVA is loaded
         model_selector = gr.Dropdown(
-            choices=models,
-            value=models[0] if len(models) > 0 else "",
+            choices=[],
+            value="",
             interactive=True,
             show_label=False,
             container=False,
@@ -871,72 +1082,88 @@ def build_demo():
 
         btn_list = [upvote_btn, downvote_btn, flag_btn, regenerate_btn, llava_clear_btn]
         upvote_btn.click(
-            LLAVA.upvote_last_response,
+            llava_upvote_last_response,
             [llava_state, model_selector],
             [llava_textbox, upvote_btn, downvote_btn, flag_btn],
+            queue=False,
         )
         downvote_btn.click(
-            LLAVA.downvote_last_response,
+            llava_downvote_last_response,
             [llava_state, model_selector],
             [llava_textbox, upvote_btn, downvote_btn, flag_btn],
+            queue=False,
         )
         flag_btn.click(
-            LLAVA.flag_last_response, [llava_state, model_selector], [llava_textbox, upvote_btn, downvote_btn, flag_btn]
+            llava_flag_last_response,
+            [llava_state, model_selector],
+            [llava_textbox, upvote_btn, downvote_btn, flag_btn],
+            queue=False,
         )
         regenerate_btn.click(
-            LLAVA.regenerate,
+            llava_regenerate,
             [llava_state, image_process_mode],
             [llava_state, llava_chatbot, llava_textbox, sketch_pad] + btn_list,
+            queue=False,
         ).then(
-            LLAVA.http_bot,
+            llava_http_bot,
             [llava_state, model_selector, temperature, top_p, max_output_tokens],
             [llava_state, llava_chatbot] + btn_list,
         )
         llava_clear_btn.click(
-            LLAVA.clear_history, None, [llava_state, llava_chatbot, llava_textbox, llava_image] + btn_list
+            llava_clear_history, None, [llava_state, llava_chatbot, llava_textbox, llava_image] + btn_list, queue=False
         )
 
         llava_textbox.submit(
-            LLAVA.add_text,
+            llava_add_text,
             [llava_state, llava_textbox, llava_image, image_process_mode],
             [llava_state, llava_chatbot, llava_textbox, llava_image] + btn_list,
+            queue=False,
         ).then(
-            LLAVA.http_bot,
+            llava_http_bot,
             [llava_state, model_selector, temperature, top_p, max_output_tokens],
             [llava_state, llava_chatbot] + btn_list,
         )
         llava_submit_btn.click(
-            LLAVA.add_text,
+            llava_add_text,
             [llava_state, llava_textbox, llava_image, image_process_mode],
             [llava_state, llava_chatbot, llava_textbox, llava_image] + btn_list,
+            queue=False,
         ).then(
-            LLAVA.http_bot,
+            llava_http_bot,
             [llava_state, model_selector, temperature, top_p, max_output_tokens],
             [llava_state, llava_chatbot] + btn_list,
         )
 
+        demo.load(sessions.open_session, [compose_state, shared_state, gligen_state], None, queue=False)
+        # a polling event holds a queue worker per open tab, it only runs until every backend is done loading
+        backend_status_poll = demo.load(backend_status, None, [backend_status_markdown, backends_done], every=2)
+        backends_done.change(None, None, None, cancels=[backend_status_poll])
+
+        # the compose and GLIGEN tabs only need GLIGEN, they don't wait for LLaVA's model list
+        demo.load(
+            switch_to_compose,
+            [],
+            [
+                task,
+                out_imagebox,
+                language_instruction,
+                grounding_instruction,
+                gligen_clear_btn,
+                gligen_gen_btn,
+                gligen_adv_options,
+            ],  # first tab show doesn't need any
+            queue=False,
+        ).then(
+            gligen_clear,
+            inputs=[task, sketch_pad_trigger, batch_size, gligen_state],
+            outputs=[sketch_pad, sketch_pad_trigger, out_imagebox, image_scale, gligen_state],
+            queue=False,
+        )
+
         if args.model_list_mode == "once":
             raise ValueError(f"Unsupported model list mode: {args.model_list_mode}")
         elif args.model_list_mode == "reload":
-            print('disable for debugging')
-            demo.load(LLAVA.load_demo_refresh_model_list, inputs=None, outputs=[llava_state, model_selector]).then(
-                switch_to_compose,
-                [],
-                [
-                    task,
-                    out_imagebox,
-                    language_instruction,
-                    grounding_instruction,
-                    gligen_clear_btn,
-                    gligen_gen_btn,
-                    gligen_adv_options,
-                ],  # first tab show doesn't need any
-            ).then(
-                GLIGEN.clear,
-                inputs=[task, sketch_pad_trigger, batch_size, gligen_state],
-                outputs=[sketch_pad, sketch_pad_trigger, out_imagebox, image_scale, gligen_state],
-                queue=False,
-            )
+            backends_done.change(llava_load_demo_refresh_model_list, [backends_done], [llava_state, model_selector])
 
         else:
             raise ValueError(f"Unknown model list mode: {args.model_list_mode}")
@@ -1000,15 +1227,61 @@ def __call__(self, parser, namespace, values, option_string=None):
     parser.add_argument("--host", type=str, default="0.0.0.0")
     parser.add_argument("--port", type=int)
     parser.add_argument("--controller-url", type=str, default="http://localhost:10000")
-    parser.add_argument("--concurrency-count", type=int, default=8)
+    parser.add_argument(
+        "--concurrency-count",
+        type=int,
+        default=64,
+        help="queued events running at once; their model calls are further limited by the backend pools below",
+    )
     parser.add_argument("--model-list-mode", type=str, default="reload", choices=["once", "reload"])
     parser.add_argument("--share", action="store_true")
     parser.add_argument("--moderate", nargs="*", default=[], action=LowercaseAction)
     parser.add_argument("--embed", action="store_true")
+    parser.add_argument("--lama-url", type=str, default="http://localhost:9171")
+    parser.add_argument("--lama-timeout", type=float, default=120.0, help="seconds to wait for an inpainted image")
+    parser.add_argument("--lama-retries", type=int, default=2)
+    parser.add_argument("--session-max-mb", type=int, default=8192, help="memory budget of all session states")
+    parser.add_argument("--session-idle-ttl", type=float, default=1800, help="seconds before idle sessions spill")
+    parser.add_argument("--session-spill-dir", type=str, default="session_spill")
+    parser.add_argument("--seem-concurrency", type=int, default=1, help="concurrent SEEM segmentations")
+    parser.add_argument("--lama-concurrency", type=int, default=4, help="concurrent requests to the LaMa server")
+    parser.add_argument("--gligen-concurrency", type=int, default=1, help="concurrent GLIGEN generations")
+    parser.add_argument("--llava-concurrency", type=int, default=4, help="concurrent LLaVA chat responses")
+    parser.add_argument(
+        "--cpu-concurrency", type=int, default=os.cpu_count() or 4, help="concurrent CPU-heavy UI handlers"
+    )
     args = parser.parse_args()
-    LLAVA.set_args(args)
+    backends.on_ready('LLaVA', lambda modules: modules['LLaVA.llava.serve.gradio_web_server'].set_args(args))
+    backends.start()
+
+    lama = LamaClient(args.lama_url, timeout=args.lama_timeout, retries=args.lama_retries)
+    # background inpainting runs here so segmentation results can be shown before LaMa is done; each queued event
+    # starts at most one, so there is a thread for every one of them and the LaMa pool decides which goes first
+    inpaint_executor = ThreadPoolExecutor(
+        max_workers=args.concurrency_count + args.lama_concurrency, thread_name_prefix="inpaint"
+    )
+    sessions.max_bytes = args.session_max_mb * 2**20
+    sessions.idle_ttl = args.session_idle_ttl
+    sessions.spill_dir = args.session_spill_dir
+    sessions.start()
+    for name, capacity in (
+        ('SEEM', args.seem_concurrency),
+        ('LaMa', args.lama_concurrency),
+        ('GLIGEN', args.gligen_concurrency),
+        ('LLaVA', args.llava_concurrency),
+        ('CPU', args.cpu_concurrency),
+    ):
+        scheduler.resize(name, capacity)
 
     demo = build_demo()
     demo.queue(concurrency_count=args.concurrency_count, api_open=False)
 
-    demo.launch(favicon_path="./demo_resources/images/llava_interactive_logo.png")
+    app, _, _ = demo.launch(favicon_path="./demo_resources/images/llava_interactive_logo.png", prevent_thread_lock=True)
+    for path, endpoint in (
+        ("/metrics/sessions", sessions.stats),
+        ("/metrics/backends", backends.status),
+        ("/metrics/scheduler", scheduler.stats),
+    ):
+        app.add_api_route(path, endpoint, methods=["GET"])
+        app.router.routes.insert(0, app.router.routes.pop())  # ahead of gradio's own routes
+    demo.block_thread()
@@ -38,8 +38,6 @@ echo "RUN_LLAVA_INT: $RUN_LLAVA_INT"
     --model-path ./llava-v1.5-13b &
 )
 
-sleep 30
-
 (
   cd lama
   pwd
@@ -50,14 +48,18 @@ sleep 30
   python ../lama_server.py &
 )
 
-sleep 10
-
 if [ "$RUN_LLAVA_INT" = "True" ]; then
   (
     pwd
     conda deactivate
     conda activate llava_int
 
+    # the models load in parallel, start the demo as soon as the slowest one is ready
+    python wait_for_ready.py \
+      --controller-url http://localhost:10000 \
+      --worker-url http://localhost:40000 \
+      --lama-url http://localhost:9171 || exit 1
+
     export LLAVA_INTERACTIVE_HOME=.
     export GRADIO_NO_RELOAD=True
 
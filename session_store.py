@@ -0,0 +1,268 @@
+import collections
+import copy
+import functools
+import inspect
+import os
+import pickle
+import threading
+import time
+import uuid
+import zlib
+
+import numpy as np
+from PIL import Image
+
+# state dicts holding this key are tracked, its value is the id of the browser session they belong to
+SESSION_KEY = '_session_id'
+
+# values smaller than this stay in memory when a session is spilled
+SPILL_MIN_BYTES = 64 * 2**10
+
+
+def estimate_nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(item) for item in value)
+    return getattr(value, 'nbytes', 0)  # e.g. ObjectLayer, SegmentIndex
+
+
+class Session:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.states = []
+        self.nbytes = 0
+        self.last_access = time.monotonic()
+        self.active = 0
+        self.spilled = []  # (state, spill file, spilled keys)
+        self.initial = []  # (state, copy of it when the session was opened)
+        self.io_lock = threading.RLock()
+
+
+class SessionStore:
+    """
+    Keeps the per-session Gradio state dicts within a memory budget. Handlers wrapped with track() mark their
+    session as in use while they run and update its byte size afterwards. A background sweeper spills the large
+    values of sessions idle for longer than idle_ttl, or of the least recently used sessions while the total is
+    above max_bytes, to compressed files in spill_dir. They are restored transparently on the next access.
+    Sessions idle for longer than expire_after are dropped together with their spill files; Gradio still holds
+    their states, so the spilled ones are reset to how the session started.
+    """
+
+    def __init__(self, max_bytes=8 * 2**30, idle_ttl=30 * 60, expire_after=24 * 60 * 60, spill_dir='session_spill'):
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.expire_after = expire_after
+        self.spill_dir = spill_dir
+        self.sessions = collections.OrderedDict()  # least recently used first
+        self.lock = threading.Lock()
+        self.spill_count = 0
+        self.restore_count = 0
+        self.sweeper = None
+        self.wake_sweeper = threading.Event()
+
+    def start(self, interval=30.0):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.sweeper = threading.Thread(
+            target=self._sweep_forever, args=(interval,), name="session-sweeper", daemon=True
+        )
+        self.sweeper.start()
+
+    def open_session(self, *states):
+        # gives all state dicts of one browser session the same id, so they are accounted together
+        session_id = uuid.uuid4().hex
+        for state in states:
+            if isinstance(state, dict) and state.get(SESSION_KEY) is None:
+                state[SESSION_KEY] = session_id
+        self._enter(states)
+        with self.lock:
+            for state in self._states_in(states, {}):
+                session = self.sessions[state[SESSION_KEY]]
+                session.initial.append((state, copy.deepcopy(state)))
+        self._exit(states)
+
+    def replace_state(self, old, new):
+        # for handlers that return a new dict in place of a tracked state, e.g. GLIGEN.clear: the new one joins the
+        # session instead of the old one
+        if new is old or not isinstance(new, dict) or old.get(SESSION_KEY) is None:
+            return new
+        new[SESSION_KEY] = old[SESSION_KEY]
+        with self.lock:
+            session = self.sessions.get(old[SESSION_KEY])
+            if session is not None:
+                session.states = [state for state in session.states if state is not old]
+                session.states.append(new)
+                session.initial = [(new if state is old else state, initial) for state, initial in session.initial]
+        return new
+
+    def track(self, fn):
+        if inspect.isgeneratorfunction(fn):
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                states = self._states_in(args, kwargs)
+                self._enter(states)
+                try:
+                    yield from fn(*args, **kwargs)
+                finally:
+                    self._exit(states)
+
+        else:
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                states = self._states_in(args, kwargs)
+                self._enter(states)
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self._exit(states)
+
+        return wrapper
+
+    def stats(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            return {
+                'sessions': len(sessions),
+                'active_sessions': sum(session.active > 0 for session in sessions),
+                'spilled_sessions': sum(len(session.spilled) > 0 for session in sessions),
+                'resident_bytes': sum(session.nbytes for session in sessions),
+                'spilled_bytes': sum(
+                    os.path.getsize(path)
+                    for session in sessions
+                    for _, path, _ in session.spilled
+                    if os.path.exists(path)
+                ),
+                'max_bytes': self.max_bytes,
+                'spills': self.spill_count,
+                'restores': self.restore_count,
+                'largest_sessions': sorted(
+                    ((session.session_id, session.nbytes) for session in sessions), key=lambda item: -item[1]
+                )[:10],
+            }
+
+    def _states_in(self, args, kwargs):
+        return [value for value in (*args, *kwargs.values()) if isinstance(value, dict) and SESSION_KEY in value]
+
+    def _enter(self, states):
+        sessions = []
+        with self.lock:
+            for state in states:
+                if state[SESSION_KEY] is None:
+                    state[SESSION_KEY] = uuid.uuid4().hex
+                session = self.sessions.get(state[SESSION_KEY])
+                if session is None:
+                    session = self.sessions[state[SESSION_KEY]] = Session(state[SESSION_KEY])
+                if not any(tracked is state for tracked in session.states):
+                    session.states.append(state)
+                if session not in sessions:
+                    sessions.append(session)
+            for session in sessions:
+                session.active += 1
+                session.last_access = time.monotonic()
+                self.sessions.move_to_end(session.session_id)
+        for session in sessions:
+            with session.io_lock:
+                self._restore(session)
+
+    def _exit(self, states):
+        over_budget = False
+        with self.lock:
+            for session_id in {state[SESSION_KEY] for state in states}:
+                session = self.sessions.get(session_id)
+                if session is None:
+                    continue
+                session.active -= 1
+                session.last_access = time.monotonic()
+                session.nbytes = sum(estimate_nbytes(state) for state in session.states)
+            over_budget = sum(session.nbytes for session in self.sessions.values()) > self.max_bytes
+        if over_budget:
+            self.wake_sweeper.set()
+
+    def _spill(self, session):
+        with session.io_lock:
+            with self.lock:
+                if session.active > 0 or session.spilled:
+                    return
+            for i, state in enumerate(session.states):
+                heavy = {key: value for key, value in state.items() if estimate_nbytes(value) >= SPILL_MIN_BYTES}
+                if not heavy:
+                    continue
+                path = os.path.join(self.spill_dir, f"{session.session_id}_{i}.pkl.z")
+                try:
+                    data = zlib.compress(pickle.dumps(heavy, protocol=pickle.HIGHEST_PROTOCOL), 1)
+                except (pickle.PicklingError, TypeError, AttributeError) as ex:
+                    print(f"Not spilling session {session.session_id}: {ex}")
+                    continue
+                with open(path, "wb") as f:
+                    f.write(data)
+                for key in heavy:
+                    del state[key]
+                session.spilled.append((state, path, list(heavy)))
+            with self.lock:
+                if session.spilled:
+                    self.spill_count += 1
+                session.nbytes = sum(estimate_nbytes(state) for state in session.states)
+
+    def _restore(self, session):
+        # called with session.io_lock held
+        if not session.spilled:
+            return
+        for state, path, _ in session.spilled:
+            with open(path, "rb") as f:
+                state.update(pickle.loads(zlib.decompress(f.read())))
+            os.remove(path)
+        session.spilled = []
+        with self.lock:
+            self.restore_count += 1
+            session.nbytes = sum(estimate_nbytes(state) for state in session.states)
+
+    def _drop(self, session):
+        with session.io_lock:
+            with self.lock:
+                if session.active > 0:
+                    return
+                self.sessions.pop(session.session_id, None)
+            for state, path, keys in session.spilled:
+                if os.path.exists(path):
+                    os.remove(path)
+                initial = next((initial for tracked, initial in session.initial if tracked is state), None)
+                if initial is not None:
+                    state.clear()
+                    state.update(copy.deepcopy(initial))
+                else:
+                    state.update(dict.fromkeys(keys, None))
+            if session.spilled:
+                print(f"Session {session.session_id} expired, its spilled states were reset")
+            session.spilled = []
+
+    def _sweep(self):
+        now = time.monotonic()
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            if now - session.last_access > self.expire_after:
+                self._drop(session)
+            elif now - session.last_access > self.idle_ttl:
+                self._spill(session)
+
+        # still over budget: spill the least recently used sessions first
+        for session in sessions:
+            with self.lock:
+                if sum(session.nbytes for session in self.sessions.values()) <= self.max_bytes:
+                    break
+            self._spill(session)
+
+    def _sweep_forever(self, interval):
+        while True:
+            self.wake_sweeper.wait(interval)
+            self.wake_sweeper.clear()
+            try:
+                self._sweep()
+            except Exception as ex:
+                print(f"Session sweep failed: {ex}")
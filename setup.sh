@@ -24,6 +24,7 @@ conda install pytorch torchvision torchaudio cudatoolkit=10.2 -c pytorch -y
 pip install torch==1.10.2+cu113 --find-links https://download.pytorch.org/whl/cu113/torch_stable.html
 pip install torchvision==0.11.3+cu113 --find-links https://download.pytorch.org/whl/cu113/torch_stable.html
 pip install flask
+pip install waitress
 pip install pytorch-lightning
 #download pretrained model
 git clone https://huggingface.co/smartywu/big-lama download
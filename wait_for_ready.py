@@ -0,0 +1,140 @@
+"""
+Waits until the LLaVA controller, the LLaVA model worker and the LaMa server are ready, so run_demo.sh can start
+llava_interactive.py as soon as the slowest model is loaded instead of after fixed sleeps. Only uses the standard
+library, so it runs in any of the demo's environments.
+
+    python wait_for_ready.py --controller-url http://localhost:10000 --worker-url http://localhost:40000 \
+        --lama-url http://localhost:9171 [--lama-workers 2]
+
+Exits with 0 once every service is ready, 1 when one failed or the timeout passed.
+"""
+import argparse
+import json
+import sys
+import time
+import urllib.error
+import urllib.request
+
+READY = 'ready'
+WAITING = 'waiting'
+FAILED = 'failed'
+
+
+class Probe:
+    # check() returns (state, detail) with state one of READY, WAITING or FAILED
+    def __init__(self, name, check):
+        self.name = name
+        self.check = check
+
+
+def http_request(url, method="GET", timeout=2.0):
+    # returns (status, body); connection errors raise OSError
+    request = urllib.request.Request(url, data=b"" if method == "POST" else None, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as ex:
+        return ex.code, ex.read()
+
+
+def controller_probe(base_url):
+    # the controller is only useful once a worker has registered a model with it
+    def check():
+        status, body = http_request(base_url.rstrip("/") + "/list_models", method="POST")
+        if status != 200:
+            return WAITING, f"HTTP {status}"
+        models = json.loads(body).get("models", [])
+        if len(models) == 0:
+            return WAITING, "no model registered yet"
+        return READY, ", ".join(models)
+
+    return Probe("controller", check)
+
+
+def worker_probe(base_url):
+    def check():
+        status, body = http_request(base_url.rstrip("/") + "/worker_get_status", method="POST")
+        if status != 200:
+            return WAITING, f"HTTP {status}"
+        return READY, ", ".join(json.loads(body).get("model_names", []))
+
+    return Probe("model worker", check)
+
+
+def lama_probe(base_url, workers=1):
+    # /readyz answers for the server process that took the request, so with several gunicorn workers it is polled
+    # until that many different processes said they are ready
+    ready_pids = set()
+
+    def check():
+        status, body = http_request(base_url.rstrip("/") + "/readyz")
+        try:
+            info = json.loads(body)
+        except ValueError:
+            info = {}
+        if status == 200:
+            ready_pids.add(info.get("pid"))
+            if len(ready_pids) < workers:
+                return WAITING, f"{len(ready_pids)} of {workers} workers ready"
+            return READY, ""
+        if info.get("status") == FAILED:
+            return FAILED, info.get("error", "")
+        return WAITING, info.get("status", f"HTTP {status}")
+
+    return Probe("lama", check)
+
+
+def wait_for_ready(probes, timeout=900.0, interval=1.0, clock=time.monotonic, sleep=time.sleep, log=print):
+    """
+    Polls every probe each interval seconds until all are ready. A probe that can't connect yet counts as waiting.
+    Returns True when all probes are ready, False as soon as one fails or after timeout seconds.
+    """
+    start = clock()
+    pending = list(probes)
+    last_seen = {}
+    while True:
+        for probe in list(pending):
+            try:
+                state, detail = probe.check()
+            except (OSError, ValueError) as ex:
+                state, detail = WAITING, f"{type(ex).__name__}: {ex}"
+            elapsed = clock() - start
+            if state == READY:
+                log(f"{probe.name} ready after {elapsed:.1f}s {detail}".rstrip())
+                pending.remove(probe)
+            elif state == FAILED:
+                log(f"{probe.name} failed after {elapsed:.1f}s: {detail}")
+                return False
+            elif last_seen.get(probe.name) != detail:
+                log(f"waiting for {probe.name}: {detail}")
+            last_seen[probe.name] = detail
+        if len(pending) == 0:
+            return True
+        if clock() - start > timeout:
+            log(f"timed out after {timeout:.0f}s waiting for {', '.join(probe.name for probe in pending)}")
+            return False
+        sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--controller-url", type=str, default=None)
+    parser.add_argument("--worker-url", type=str, default=None)
+    parser.add_argument("--lama-url", type=str, default=None)
+    parser.add_argument("--lama-workers", type=int, default=1, help="worker processes the LaMa server runs")
+    parser.add_argument("--timeout", type=float, default=900.0, help="seconds to wait for all services")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between polls")
+    args = parser.parse_args()
+
+    probes = []
+    if args.controller_url is not None:
+        probes.append(controller_probe(args.controller_url))
+    if args.worker_url is not None:
+        probes.append(worker_probe(args.worker_url))
+    if args.lama_url is not None:
+        probes.append(lama_probe(args.lama_url, args.lama_workers))
+    sys.exit(0 if wait_for_ready(probes, timeout=args.timeout, interval=args.interval) else 1)
+
+
+if __name__ == "__main__":
+    main()